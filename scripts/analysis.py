@@ -1,22 +1,29 @@
 """seed_cell_size_2d analysis."""
 
 import os
+import sys
+import glob
 import json
 import logging
 import argparse
+import multiprocessing
+
+from multiprocessing.pool import ThreadPool
+from contextlib import contextmanager
 
 import numpy as np
+import PIL.Image
+import PIL.ImageDraw
+import PIL.ImageFont
 
 from scipy.misc import imsave
 
-import skimage.filters
 import skimage.segmentation
 
-from skimage.measure import regionprops
-
 from jicbioimage.core.image import Image
 from jicbioimage.core.transform import transformation
 from jicbioimage.core.io import AutoName, AutoWrite
+from jicbioimage.core.util.array import normalise, pretty_color_array
 from jicbioimage.segment import connected_components
 from jicbioimage.segment import SegmentedImage
 
@@ -26,19 +33,58 @@ from jicbioimage.transform import (
     remove_small_objects
 )
 
-from jicbioimage.illustrate import AnnotatedImage
+from jicbioimage.illustrate import AnnotatedImage, DEFAULT_FONT_PATH
+
+from cellparameters import COLUMNS, parameterise_cells
+from instrumentation import (
+    describe_array,
+    instrumented,
+    measure,
+    start_recording,
+    stop_recording,
+    write_records
+)
+from localthreshold import METHODS, local_threshold
+from microscopy import (
+    ConversionError,
+    is_container,
+    iter_series,
+    series_name
+)
+from tiledsegment import segment_tiled
 
-__version__ = "0.0.1"
+__version__ = "0.0.2"
 
 AutoName.prefix_format = "{:03d}_"
 
+LABEL_COLUMNS = ['identifier', 'centroid_row', 'centroid_col']
+
+IMAGE_OUTPUTS = [
+    'original.png',
+    'false_color.png',
+    'segmentation.png',
+    'labels.png'
+]
+OUTPUTS = IMAGE_OUTPUTS + ['results.csv', 'results.npz']
+
+DEFAULT_PNG_COMPRESSION = 6
+DEFAULT_PNG_WORKERS = 2
+
+# Record the imported stages of the pipeline when profiling.
+parameterise_cells = instrumented(parameterise_cells)
+invert = instrumented(invert)
+remove_small_objects = instrumented(remove_small_objects)
+connected_components = instrumented(connected_components)
 
+
+@instrumented
 @transformation
 def identity(image):
     """Return the image as is."""
     return image
 
 
+@instrumented
 @transformation
 def clear_border(image):
     cleared = skimage.segmentation.clear_border(image)
@@ -46,52 +92,59 @@ def clear_border(image):
     return cleared.view(SegmentedImage)
 
 
+@instrumented
 @transformation
 def remove_small_regions(segmentation, threshold=1000):
+    """Remove regions with an area smaller than threshold.
+
+    The areas of all regions are found in a single pass over the image and
+    the small regions removed using a lookup table indexed by label.
+    """
+
+    areas = np.bincount(segmentation.ravel())
+
+    is_small = areas < threshold
+    is_small[0] = False
 
-    for id in segmentation.identifiers:
-        if segmentation.region_by_identifier(id).area < threshold:
-            segmentation.remove_region(id)
+    segmentation[is_small[segmentation]] = 0
 
     return segmentation
 
 
+@instrumented
 @transformation
-def threshold_adaptive(image, block_size=91):
+def threshold_adaptive(image, block_size=91, method='gaussian'):
 
-    thresholded = skimage.filters.threshold_adaptive(image, block_size)
+    thresholded = local_threshold(image, block_size, method)
 
     return thresholded
 
 
-def parameterise_cells(segmentation):
+@instrumented
+def preprocess_and_segment(image, block_size=91, threshold_method='gaussian',
+                           tile_size=None, tile_halo=None, tile_workers=None):
+    """Return the segmentation of the cells in the image.
 
-    all_cell_props = regionprops(segmentation)
+    If tile_size is given the image is segmented in overlapping tiles, in
+    parallel, to bound memory use on large images.
+    """
 
-    cell_information = []
-    for props in all_cell_props:
-
-        centroid_row, centroid_col = props.centroid
-        cell_entry = dict(
-            width=int(props.minor_axis_length),
-            length=int(props.major_axis_length),
-            area=props.area,
-            identifier=props.label,
-            perimeter=props.perimeter,
-            convex_area=props.convex_area,
-            centroid_row=centroid_row,
-            centroid_col=centroid_col
+    if tile_size:
+        labels = segment_tiled(
+            image,
+            tile_size=tile_size,
+            halo=tile_halo,
+            block_size=block_size,
+            threshold_method=threshold_method,
+            num_workers=tile_workers
         )
+        segmentation = SegmentedImage.from_array(labels)
+        segmentation = remove_small_regions(segmentation)
 
-        cell_information.append(cell_entry)
-
-    return cell_information
-
-
-def preprocess_and_segment(image):
+        return segmentation
 
     image = identity(image)
-    image = threshold_adaptive(image)
+    image = threshold_adaptive(image, block_size, threshold_method)
     image = remove_small_objects(image)
     image = invert(image)
     image = remove_small_objects(image)
@@ -104,86 +157,468 @@ def preprocess_and_segment(image):
     return segmentation
 
 
+@instrumented
 def write_cell_info_to_csv(cell_info, csv_path):
-    """Take the list of dictionaries provided by cell_info and write it in
+    """Take the dictionary of columns provided by cell_info and write it in
     tabular form to the CSV file csv_path."""
 
     # Turn this into a variable to keep a consistent ordering. Sort and make
     # sure that identifier is first
-    headers = cell_info[0].keys()
-    headers.sort()
-    headers.remove('identifier')
-    headers.insert(0, 'identifier')
+    headers = sorted(cell_info.keys())
+    if 'identifier' in headers:
+        headers.remove('identifier')
+        headers.insert(0, 'identifier')
 
     with open(csv_path, 'w') as fh:
         header_line = ','.join(headers) + '\n'
         fh.write(header_line)
 
-        for entry in cell_info:
-            data = [str(entry[h]) for h in headers]
-            line = ','.join(data) + '\n'
+        columns = [cell_info[h].tolist() for h in headers]
+        for row in zip(*columns):
+            line = ','.join(str(v) for v in row) + '\n'
             fh.write(line)
 
 
-def write_segmented_image_as_rgb(segmented_image, output_fpath):
+@instrumented
+def write_cell_info_to_npz(cell_info, npz_path):
+    """Write the columns provided by cell_info as arrays in the numpy .npz
+    file npz_path, keeping their full precision."""
+
+    np.savez(npz_path, **cell_info)
+
+
+def png_array(image):
+    """Return the 8 bit array that image.png() would encode."""
+
+    if isinstance(image, SegmentedImage):
+        return pretty_color_array(image)
+
+    if image.dtype != np.uint8:
+        image = 255 * normalise(image)
+
+    return np.asarray(image).astype(np.uint8)
+
+
+def write_png(image, fpath, compression=DEFAULT_PNG_COMPRESSION):
+    """Write the image to fpath in PNG format.
+
+    :param compression: zlib compression level, from 0 (none, fastest) to 9
+    """
+
+    info = describe_array('input', image)
+    with measure('write_png', fname=os.path.basename(fpath), **info):
+        array = png_array(image)
+        PIL.Image.fromarray(array).save(
+            fpath,
+            format='PNG',
+            compress_level=compression
+        )
+
+
+@instrumented
+def write_segmented_image_as_rgb(segmented_image, output_fpath,
+                                 compression=DEFAULT_PNG_COMPRESSION):
 
     segmentation_as_rgb = segmented_image.unique_color_image
 
-    with open(output_fpath, 'wb') as f:
-        f.write(segmentation_as_rgb.png())
+    write_png(segmentation_as_rgb, output_fpath, compression)
 
 
-def generate_label_image(segmentation):
+class BackgroundWriter(object):
+    """Run image writing functions in a pool of background threads.
+
+    Rendering and PNG compression mostly happen outside of the GIL, so the
+    images are written while the next stage of the analysis runs. Leaving the
+    context waits for the writes to finish and raises the first error. With
+    no workers the functions are run straight away in the calling thread.
+    """
+
+    def __init__(self, workers=DEFAULT_PNG_WORKERS):
+        self.pool = ThreadPool(workers) if workers else None
+        self.pending = []
+
+    def submit(self, func, *args):
+        if self.pool is None:
+            func(*args)
+        else:
+            self.pending.append(self.pool.apply_async(func, args))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.pool is None:
+            return
+
+        try:
+            if exc_type is None:
+                for result in self.pending:
+                    result.get()
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+
+@instrumented
+def generate_label_image(segmentation, cell_info=None):
+    """Return an annotated image with the identifier of each cell written at
+    its centroid.
+
+    The centroids are taken from cell_info if it has them, otherwise they are
+    computed for all cells in a single pass. The labels are all drawn onto one
+    text layer, which is then applied to the image in one go.
+    """
+
+    if cell_info is None or not all(c in cell_info for c in LABEL_COLUMNS):
+        cell_info = parameterise_cells(segmentation, LABEL_COLUMNS)
 
     base_for_ann = 100 * (segmentation > 0)
     ann = AnnotatedImage.from_grayscale(base_for_ann)
 
-    for sid in segmentation.identifiers:
-        c = segmentation.region_by_identifier(sid).centroid
-        ann.text_at(
-            str(sid),
-            map(int, c),
-            size=30,
-            color=(255, 255, 0),
-            center=True
+    nrows, ncols = segmentation.shape
+    text_layer = PIL.Image.new('L', (ncols, nrows), 0)
+    draw = PIL.ImageDraw.Draw(text_layer)
+    font = PIL.ImageFont.truetype(DEFAULT_FONT_PATH, size=30)
+
+    for sid, row, col in zip(*[cell_info[c].tolist() for c in LABEL_COLUMNS]):
+        text = str(sid)
+        mask, (xoffset, yoffset) = font.getmask2(text)
+        width, height = mask.size
+        position = (
+            int(col) - width // 2 - xoffset,
+            int(row) - height // 2 - yoffset
         )
+        draw.text(position, text, fill=255, font=font)
+
+    ann[np.asarray(text_layer) > 127] = (255, 255, 0)
 
     return ann
 
 
-def analyse_file(fpath, output_directory):
-    """Analyse a single file."""
+@contextmanager
+def profiled(output_directory, input_file, profile=False):
+    """If profile is set, write measurements of the stages run in the
+    context to profile.json in the output directory."""
+
+    if profile:
+        start_recording()
+
+    try:
+        yield
+    finally:
+        if profile:
+            write_records(
+                stop_recording(),
+                os.path.join(output_directory, 'profile.json'),
+                input_file=input_file,
+                analysis_version=__version__
+            )
+
+
+def analyse_image(image, output_directory, columns=COLUMNS, block_size=91,
+                  threshold_method='gaussian', tile_size=None,
+                  tile_halo=None, tile_workers=None, outputs=OUTPUTS,
+                  png_compression=DEFAULT_PNG_COMPRESSION,
+                  png_workers=DEFAULT_PNG_WORKERS):
+    """Analyse an image that has already been read.
+
+    Only the outputs listed are written; images that are not wanted are not
+    rendered. The images are encoded in png_workers background threads.
+    """
+
+    unknown = set(outputs) - set(OUTPUTS)
+    if unknown:
+        raise ValueError("Unknown outputs: {}".format(
+            ", ".join(sorted(unknown)))
+        )
+
+    def path(fname):
+        return os.path.join(output_directory, fname)
+
+    with BackgroundWriter(png_workers) as writer:
+        if 'original.png' in outputs:
+            writer.submit(
+                write_png, image, path('original.png'), png_compression
+            )
+
+        segmentation = preprocess_and_segment(
+            image,
+            block_size=block_size,
+            threshold_method=threshold_method,
+            tile_size=tile_size,
+            tile_halo=tile_halo,
+            tile_workers=tile_workers
+        )
+
+        if 'false_color.png' in outputs:
+            writer.submit(
+                write_png,
+                segmentation,
+                path('false_color.png'),
+                png_compression
+            )
+
+        if 'segmentation.png' in outputs:
+            writer.submit(
+                write_segmented_image_as_rgb,
+                segmentation,
+                path('segmentation.png'),
+                png_compression
+            )
+
+        cell_info = None
+        if 'results.csv' in outputs or 'results.npz' in outputs:
+            cell_info = parameterise_cells(segmentation, columns)
+        if 'results.csv' in outputs:
+            write_cell_info_to_csv(cell_info, path('results.csv'))
+        if 'results.npz' in outputs:
+            write_cell_info_to_npz(cell_info, path('results.npz'))
+
+        if 'labels.png' in outputs:
+            label_image = generate_label_image(segmentation, cell_info)
+            writer.submit(
+                write_png, label_image, path('labels.png'), png_compression
+            )
+
+
+def analyse_file(fpath, output_directory, profile=False, **options):
+    """Analyse a single file.
+
+    If profile is set, measurements of each stage are written to
+    profile.json in the output directory. Any extra keyword arguments are
+    passed on to :func:`analyse_image`.
+    """
     logging.info("Analysing file: {}".format(fpath))
-    image = Image.from_file(fpath)
 
-    image_output_fpath = os.path.join(output_directory, 'original.png')
-    with open(image_output_fpath, 'wb') as fh:
-        fh.write(image.png())
+    with profiled(output_directory, fpath, profile):
+        with measure('read_image'):
+            image = Image.from_file(fpath)
+
+        analyse_image(image, output_directory, **options)
+
+
+def analyse_container(fpath, output_root, debug=False, profile=False,
+                      **options):
+    """Analyse each series of a multi-series microscopy file as it is read.
+
+    Each series gets its own output directory in the output root, named
+    after the series, with its own audit log. Only one plane is held in
+    memory at a time. Failures are logged per series and do not stop the
+    analysis of the others. If the conversion itself fails, the series
+    analysed so far are kept and the failure is logged to the output root.
+    Any extra keyword arguments are passed on to :func:`analyse_image`.
+
+    :returns: list of (series, error message) tuples for the series that
+              failed
+    """
+
+    failures = []
+    try:
+        for series, image in iter_series(fpath):
+            output_directory = os.path.join(output_root, series_name(series))
+            if not os.path.isdir(output_directory):
+                os.makedirs(output_directory)
+
+            configure_output(output_directory, debug)
+            with audit_log(output_directory, debug):
+                logging.info("Analysing series {} of file: {}".format(
+                    series,
+                    fpath)
+                )
+                input_file = "{}#{}".format(fpath, series)
+                try:
+                    with profiled(output_directory, input_file, profile):
+                        analyse_image(image, output_directory, **options)
+                except Exception as e:
+                    logging.exception("Failed to analyse series {} of file: "
+                                      "{}".format(series, fpath))
+                    failures.append(
+                        (series, "{}: {}".format(type(e).__name__, e))
+                    )
+
+            # Let go of the plane before the next one is read.
+            del image
+    except ConversionError as e:
+        # bfconvert does not carry on past a failure, so the remaining series
+        # are reported as one failure of the container.
+        with audit_log(output_root, debug):
+            logging.error("Failed to convert file: {}: {}".format(fpath, e))
+        failures.append((e.series, "{}: {}".format(type(e).__name__, e)))
+
+    return failures
+
+
+@contextmanager
+def audit_log(output_directory, debug=False):
+    """Write log messages to an audit.log file in the output directory for the
+    duration of the context."""
+
+    log_fpath = os.path.join(output_directory, "audit.log")
+    handler = logging.FileHandler(log_fpath)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    logger = logging.getLogger()
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG if debug else logging.INFO)
 
-    segmentation = preprocess_and_segment(image)
+    # Log some basic information about the script that is running.
+    logging.info("Script name: {}".format(__file__))
+    logging.info("Script version: {}".format(__version__))
 
-    false_colour_fpath = os.path.join(output_directory, 'false_color.png')
-    with open(false_colour_fpath, 'wb') as fh:
-        fh.write(segmentation.png())
+    try:
+        yield
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
 
-    rgb_segmentation_fpath = os.path.join(output_directory, 'segmentation.png')
-    write_segmented_image_as_rgb(segmentation, rgb_segmentation_fpath)
 
-    cell_info = parameterise_cells(segmentation)
-    csv_fpath = os.path.join(output_directory, 'results.csv')
-    write_cell_info_to_csv(cell_info, csv_fpath)
+def configure_output(output_directory, debug=False):
+    """Point the automatic naming and writing of intermediate images at the
+    output directory."""
 
-    label_image = generate_label_image(segmentation)
-    label_image_fpath = os.path.join(output_directory, 'labels.png')
-    with open(label_image_fpath, 'wb') as fh:
-        fh.write(label_image.png())
+    AutoName.directory = output_directory
+    AutoName.count = 0
+
+    # Only write out intermediate images in debug mode.
+    AutoWrite.on = debug
+
+
+def read_manifest(manifest_fpath):
+    """Return the input file paths listed one per line in the manifest file,
+    reading from stdin if the manifest file path is "-"."""
+
+    if manifest_fpath == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with open(manifest_fpath) as fh:
+            lines = fh.readlines()
+
+    return [line.strip() for line in lines if line.strip()]
+
+
+def output_directory_for(fpath, output_root):
+    """Return the output directory for an input file in a batch."""
+
+    name, _ = os.path.splitext(os.path.basename(fpath))
+
+    return os.path.join(output_root, name)
+
+
+def analyse_file_in_batch(job):
+    """Analyse a single file of a batch, returning the input file path and an
+    error message, or None if the analysis succeeded."""
+
+    fpath, output_directory, debug, options = job
+
+    try:
+        if not os.path.isdir(output_directory):
+            os.makedirs(output_directory)
+        if is_container(fpath):
+            failures = analyse_container(
+                fpath,
+                output_directory,
+                debug,
+                **options
+            )
+            if failures:
+                return fpath, "Failed on series {}".format(
+                    ", ".join(str(series) for series, _ in failures)
+                )
+        else:
+            configure_output(output_directory, debug)
+            with audit_log(output_directory, debug):
+                try:
+                    analyse_file(fpath, output_directory, **options)
+                except Exception:
+                    logging.exception(
+                        "Failed to analyse file: {}".format(fpath)
+                    )
+                    raise
+    except Exception as e:
+        return fpath, "{}: {}".format(type(e).__name__, e)
+
+    return fpath, None
+
+
+def analyse_batch(fpaths, output_root, processes=None, debug=False,
+                  **options):
+    """Analyse many files using a pool of worker processes.
+
+    Each file gets its own output directory, named after the file, in the
+    output root. The series of multi-series microscopy files are analysed
+    into subdirectories of it. Failures are reported per file and do not
+    stop the batch. Any extra keyword arguments are passed on to
+    :func:`analyse_file`.
+
+    :returns: list of (input file path, error message) tuples for the files
+              that failed
+    """
+
+    jobs = [(fpath, output_directory_for(fpath, output_root), debug, options)
+            for fpath in fpaths]
+
+    failures = []
+    pool = multiprocessing.Pool(processes)
+    try:
+        for fpath, error in pool.imap_unordered(analyse_file_in_batch, jobs):
+            if error is None:
+                print("Analysed {}".format(fpath))
+            else:
+                print("Failed {}: {}".format(fpath, error))
+                failures.append((fpath, error))
+    finally:
+        pool.close()
+        pool.join()
+
+    return failures
 
 
 def main():
     # Parse the command line arguments.
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("--input-file", "-i", help="Input file")
-    parser.add_argument("--output-directory", "-o", help="Output directory")
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument("--input-file", "-i", help="Input file")
+    inputs.add_argument("--input-manifest", "-m",
+                        help="File listing input files, one per line "
+                             "('-' to read from stdin)")
+    inputs.add_argument("--input-glob", "-g",
+                        help="Glob pattern matching input files")
+    parser.add_argument("--output-directory", "-o",
+                        help="Output directory (output root in batch mode)")
+    parser.add_argument("--processes", "-p", type=int, default=None,
+                        help="Number of worker processes in batch mode "
+                             "(default: number of CPUs)")
+    parser.add_argument("--columns", default=",".join(COLUMNS),
+                        help="Comma separated cell measurements to compute "
+                             "(default: {})".format(",".join(COLUMNS)))
+    parser.add_argument("--threshold-method", choices=METHODS,
+                        default="gaussian",
+                        help="Local threshold method (default: gaussian)")
+    parser.add_argument("--block-size", type=int, default=91,
+                        help="Block size of the local threshold (default: 91)")
+    parser.add_argument("--tile-size", type=int, default=None,
+                        help="Segment in tiles of this size to bound memory "
+                             "use on large images")
+    parser.add_argument("--tile-halo", type=int, default=None,
+                        help="Pixels of context around each tile")
+    parser.add_argument("--tile-workers", type=int, default=None,
+                        help="Number of tiles to segment in parallel "
+                             "(default: number of CPUs)")
+    parser.add_argument("--outputs", default=",".join(OUTPUTS),
+                        help="Comma separated outputs to write "
+                             "(default: {})".format(",".join(OUTPUTS)))
+    parser.add_argument("--png-compression", type=int,
+                        choices=range(10), default=DEFAULT_PNG_COMPRESSION,
+                        help="PNG compression level, from 0 (fastest) to 9 "
+                             "(default: {})".format(DEFAULT_PNG_COMPRESSION))
+    parser.add_argument("--png-workers", type=int,
+                        default=DEFAULT_PNG_WORKERS,
+                        help="Number of threads encoding images in the "
+                             "background, 0 to encode them in turn "
+                             "(default: {})".format(DEFAULT_PNG_WORKERS))
+    parser.add_argument("--profile", default=False, action="store_true",
+                        help="Write measurements of each stage to "
+                             "profile.json")
     parser.add_argument("--debug", default=False, action="store_true",
                         help="Write out intermediate images")
     args = parser.parse_args()
@@ -191,25 +626,74 @@ def main():
     if not os.path.isdir(args.output_directory):
         parser.error("Not a directory: {}".format(args.output_directory))
 
-    AutoName.directory = args.output_directory
-
-    # Only write out intermediate images in debug mode.
-    if not args.debug:
-        AutoWrite.on = False
-
-    # Setup a logger for the script.
-    log_fname = "audit.log"
-    log_fpath = os.path.join(args.output_directory, log_fname)
-    logging_level = logging.INFO
-    if args.debug:
-        logging_level = logging.DEBUG
-    logging.basicConfig(filename=log_fpath, level=logging_level)
-
-    # Log some basic information about the script that is running.
-    logging.info("Script name: {}".format(__file__))
-    logging.info("Script version: {}".format(__version__))
+    columns = args.columns.split(",")
+    unknown = set(columns) - set(COLUMNS)
+    if unknown:
+        parser.error("Unknown columns: {}".format(", ".join(sorted(unknown))))
+
+    outputs = args.outputs.split(",")
+    unknown = set(outputs) - set(OUTPUTS)
+    if unknown:
+        parser.error("Unknown outputs: {}".format(", ".join(sorted(unknown))))
+
+    options = dict(
+        columns=columns,
+        block_size=args.block_size,
+        threshold_method=args.threshold_method,
+        tile_size=args.tile_size,
+        tile_halo=args.tile_halo,
+        tile_workers=args.tile_workers,
+        outputs=outputs,
+        png_compression=args.png_compression,
+        png_workers=args.png_workers,
+        profile=args.profile
+    )
+
+    if args.input_file is not None and is_container(args.input_file):
+        failures = analyse_container(
+            args.input_file,
+            args.output_directory,
+            args.debug,
+            **options
+        )
+        for series, error in failures:
+            print("Failed series {}: {}".format(series, error))
+        if failures:
+            sys.exit(1)
+        return
+
+    if args.input_file is not None:
+        configure_output(args.output_directory, args.debug)
+        with audit_log(args.output_directory, args.debug):
+            analyse_file(args.input_file, args.output_directory, **options)
+        return
+
+    if args.input_manifest is not None:
+        fpaths = read_manifest(args.input_manifest)
+    else:
+        fpaths = sorted(glob.glob(args.input_glob))
+
+    output_directories = [output_directory_for(f, args.output_directory)
+                          for f in fpaths]
+    if len(set(output_directories)) != len(output_directories):
+        parser.error("Input files must have unique names in batch mode")
+
+    failures = analyse_batch(
+        fpaths,
+        args.output_directory,
+        processes=args.processes,
+        debug=args.debug,
+        **options
+    )
+
+    print("Analysed {} of {} files".format(
+        len(fpaths) - len(failures),
+        len(fpaths)
+        )
+    )
 
-    analyse_file(args.input_file, args.output_directory)
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
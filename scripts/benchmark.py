@@ -0,0 +1,233 @@
+"""Benchmark the stages of the analysis on synthetic seed cell images.
+
+The synthetic images are Voronoi tessellations: bright cells separated by dark
+walls, on an uneven background with added noise. Each stage of analyse_file
+is timed separately, recording the wall time and the peak memory above the
+resident set size at the start of the stage. The results are written as JSON
+so that runs can be compared over time.
+"""
+
+import os
+import json
+import time
+import platform
+
+from contextlib import contextmanager
+
+import click
+import numpy as np
+
+import scipy.ndimage
+from scipy.spatial import cKDTree
+
+from jicbioimage.core.image import Image
+
+import analysis
+
+from dtoolutils import temp_working_dir
+from memusage import PeakMemorySampler
+
+
+def synthetic_seed_cell_image(
+    size=2048,
+    num_cells=500,
+    noise=10.0,
+    wall_width=4.0,
+    seed=0
+):
+    """Return a synthetic grayscale image of a tessellation of cells.
+
+    :param size: width and height of the image
+    :param num_cells: number of cells in the tessellation
+    :param noise: standard deviation of the gaussian noise
+    :param wall_width: width of the dark walls between cells
+    :param seed: seed of the random number generator
+    """
+
+    random_state = np.random.RandomState(seed)
+
+    centres = random_state.uniform(0, size, (num_cells, 2))
+    tree = cKDTree(centres)
+
+    # A pixel is on a wall if it is about as close to its second nearest cell
+    # centre as to its nearest. Query a band of rows at a time to bound the
+    # memory used.
+    wall = np.empty((size, size), dtype=bool)
+    cols = np.arange(size)
+    for row in range(size):
+        points = np.column_stack([np.repeat(row, size), cols])
+        distances, _ = tree.query(points, k=2)
+        wall[row] = (distances[:, 1] - distances[:, 0]) < wall_width
+
+    # Uneven illumination, so that a global threshold does not work.
+    background = scipy.ndimage.gaussian_filter(
+        random_state.uniform(0, 1, (size // 64 + 1, size // 64 + 1)),
+        1
+    )
+    background = scipy.ndimage.zoom(background, 64, order=1)[:size, :size]
+    background = 60 * (background - background.min()) / np.ptp(background)
+
+    image = np.where(wall, 60.0, 160.0) + background
+    image += random_state.normal(0, noise, image.shape)
+
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+class StageTimer(object):
+    """Record the wall time and peak memory of named stages."""
+
+    def __init__(self):
+        self.memory = PeakMemorySampler()
+        self.results = []
+
+    @contextmanager
+    def stage(self, name, **info):
+        token, start_rss = self.memory.start()
+        start = time.time()
+
+        yield
+
+        wall_time = time.time() - start
+        peak_rss = self.memory.stop(token)
+
+        result = dict(
+            stage=name,
+            wall_time=wall_time,
+            peak_memory_bytes=peak_rss - start_rss
+        )
+        result.update(info)
+        self.results.append(result)
+
+
+def benchmark_stages(image, timer, output_directory, options, **info):
+    """Run the stages of analyse_file on the image, timing each one."""
+
+    analysis.configure_output(output_directory)
+
+    def path(fname):
+        return os.path.join(output_directory, fname)
+
+    with timer.stage('write_original_png', **info):
+        analysis.write_png(image, path('original.png'))
+
+    with timer.stage('preprocess_and_segment', **info):
+        segmentation = analysis.preprocess_and_segment(image, **options)
+
+    with timer.stage('write_false_color_png', **info):
+        analysis.write_png(segmentation, path('false_color.png'))
+
+    with timer.stage('write_segmentation_png', **info):
+        analysis.write_segmented_image_as_rgb(
+            segmentation,
+            path('segmentation.png')
+        )
+
+    with timer.stage('parameterise_cells', **info):
+        cell_info = analysis.parameterise_cells(segmentation)
+
+    with timer.stage('write_cell_info_to_csv', **info):
+        analysis.write_cell_info_to_csv(cell_info, path('results.csv'))
+
+    with timer.stage('write_cell_info_to_npz', **info):
+        analysis.write_cell_info_to_npz(cell_info, path('results.npz'))
+
+    with timer.stage('generate_label_image', **info):
+        label_image = analysis.generate_label_image(segmentation, cell_info)
+
+    with timer.stage('write_labels_png', **info):
+        analysis.write_png(label_image, path('labels.png'))
+
+
+def summarise(results):
+    """Return the median wall time and the largest peak memory of each stage,
+    in the order the stages were run."""
+
+    stages = []
+    for result in results:
+        if result['stage'] not in stages:
+            stages.append(result['stage'])
+
+    summary = []
+    for stage in stages:
+        stage_results = [r for r in results if r['stage'] == stage]
+        summary.append(dict(
+            stage=stage,
+            median_wall_time=float(
+                np.median([r['wall_time'] for r in stage_results])
+            ),
+            max_peak_memory_bytes=max(
+                r['peak_memory_bytes'] for r in stage_results
+            )
+        ))
+
+    return summary
+
+
+@click.command()
+@click.option('--size', type=int, default=2048,
+              help='Width and height of the synthetic images')
+@click.option('--cells', type=int, default=500,
+              help='Number of cells in the synthetic images')
+@click.option('--noise', type=float, default=10.0,
+              help='Standard deviation of the noise in the synthetic images')
+@click.option('--repeat', type=int, default=3,
+              help='Number of times to run each stage')
+@click.option('--threshold-method', type=click.Choice(analysis.METHODS),
+              default='gaussian')
+@click.option('--tile-size', type=int, default=None)
+@click.option('--output', default=None,
+              help='JSON file to write results to '
+                   '(default: benchmark-<timestamp>.json)')
+def main(size, cells, noise, repeat, threshold_method, tile_size, output):
+
+    parameters = dict(
+        size=size,
+        cells=cells,
+        noise=noise,
+        repeat=repeat,
+        threshold_method=threshold_method,
+        tile_size=tile_size
+    )
+    options = dict(threshold_method=threshold_method, tile_size=tile_size)
+
+    timer = StageTimer()
+
+    with timer.stage('generate_synthetic_image'):
+        array = synthetic_seed_cell_image(size, cells, noise)
+    image = Image.from_array(array)
+
+    for i in range(repeat):
+        with temp_working_dir() as output_directory:
+            benchmark_stages(image, timer, output_directory, options, run=i)
+
+    summary = summarise(timer.results)
+
+    for entry in summary:
+        print("{:<26} {:>9.3f} s {:>9.1f} MB".format(
+            entry['stage'],
+            entry['median_wall_time'],
+            entry['max_peak_memory_bytes'] / 1e6
+            )
+        )
+
+    if output is None:
+        output = 'benchmark-{}.json'.format(time.strftime('%Y%m%dT%H%M%S'))
+
+    with open(output, 'w') as fh:
+        json.dump(
+            dict(
+                timestamp=time.time(),
+                analysis_version=analysis.__version__,
+                platform=platform.platform(),
+                python_version=platform.python_version(),
+                parameters=parameters,
+                summary=summary,
+                results=timer.results
+            ),
+            fh,
+            indent=2
+        )
+
+
+if __name__ == '__main__':
+    main()
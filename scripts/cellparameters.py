@@ -0,0 +1,271 @@
+"""Columnar parameterisation of the cells in a segmentation.
+
+Each measurement is computed for all cells at once and returned as a NumPy
+array, giving a struct-of-arrays keyed by column name. The arrays are ordered
+by cell identifier. Sums over the cells are accumulated in bands of rows, so
+that the temporary arrays are the size of a band rather than the image.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+from skimage.morphology import convex_hull_image
+from scipy.ndimage import find_objects
+
+# Names of all the columns that can be computed. Only the requested columns
+# are computed, so that expensive ones such as convex_area can be skipped.
+COLUMNS = [
+    'identifier',
+    'area',
+    'centroid_row',
+    'centroid_col',
+    'width',
+    'length',
+    'perimeter',
+    'convex_area',
+]
+
+# Weights of the border pixel configurations used by skimage's perimeter
+# estimate with 4-connectivity.
+PERIMETER_WEIGHTS = np.zeros(50, dtype=np.double)
+PERIMETER_WEIGHTS[[5, 7, 15, 17, 25, 27]] = 1
+PERIMETER_WEIGHTS[[21, 33]] = np.sqrt(2)
+PERIMETER_WEIGHTS[[13, 23]] = (1 + np.sqrt(2)) / 2
+
+# Approximate number of pixels in each band of rows.
+BAND_PIXELS = 2 ** 20
+
+PERIMETER_KERNEL = [
+    ((-1, -1), 10), ((-1, 0), 2), ((-1, 1), 10),
+    ((0, -1), 2), ((0, 1), 2),
+    ((1, -1), 10), ((1, 0), 2), ((1, 1), 10),
+]
+
+
+def _shifted(padded, offset, shape):
+    """Return the view of a padded array shifted by the (row, col) offset."""
+    row, col = offset
+    nrows, ncols = shape
+    return padded[1 + row:1 + row + nrows, 1 + col:1 + col + ncols]
+
+
+def perimeter_weights(labels):
+    """Return the contribution of each pixel to skimage's 4-connectivity
+    perimeter estimate of its cell."""
+
+    shape = labels.shape
+    padded = np.pad(labels, 1, mode='constant')
+
+    # Border pixels are cell pixels with a 4-connected neighbour that
+    # belongs to a different cell, the background or lies outside the
+    # image.
+    border = np.zeros(shape, dtype=bool)
+    for offset in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+        border |= _shifted(padded, offset, shape) != labels
+    border &= labels > 0
+
+    border_labels = np.where(border, labels, 0)
+    padded_border = np.pad(border_labels, 1, mode='constant')
+
+    # Encode the configuration of the border pixels of the same cell
+    # around each border pixel.
+    configuration = border.astype(np.intp)
+    for offset, weight in PERIMETER_KERNEL:
+        neighbour = _shifted(padded_border, offset, shape)
+        configuration += weight * (border & (neighbour == border_labels))
+
+    return np.where(border, PERIMETER_WEIGHTS[configuration], 0)
+
+
+class CellMeasurer(object):
+    """Compute measurements of all the cells in a segmentation.
+
+    Intermediate results shared by several measurements, such as the
+    centroids, are computed once and cached.
+    """
+
+    def __init__(self, segmentation):
+        self.labels = np.asarray(segmentation)
+        self._cache = {}
+
+        nrows, ncols = self.labels.shape
+        self.band_rows = max(1, BAND_PIXELS // max(ncols, 1))
+
+        num_labels = int(self.labels.max()) + 1 if self.labels.size else 1
+        self.counts = np.zeros(num_labels, dtype=np.intp)
+        for start, stop in self._bands():
+            self.counts += np.bincount(
+                self.labels[start:stop].ravel(),
+                minlength=num_labels
+            )
+        self.identifiers = np.flatnonzero(self.counts[1:]) + 1
+
+    def _bands(self):
+        """Yield the first and last rows, plus one, of each band."""
+        nrows = self.labels.shape[0]
+        for start in range(0, nrows, self.band_rows):
+            yield start, min(start + self.band_rows, nrows)
+
+    def _label_sums(self, weights_for_band):
+        """Return the sums of the weights over each cell.
+
+        :param weights_for_band: function of the first and last rows, plus
+                                 one, of a band that returns a list of arrays
+                                 of weights of the pixels in the band
+        """
+        sums = None
+        for start, stop in self._bands():
+            labels = self.labels[start:stop].ravel()
+            band_sums = [
+                np.bincount(
+                    labels,
+                    weights=weights.ravel(),
+                    minlength=len(self.counts)
+                )
+                for weights in weights_for_band(start, stop)
+            ]
+            if sums is None:
+                sums = band_sums
+            else:
+                for total, band_sum in zip(sums, band_sums):
+                    total += band_sum
+
+        if sums is None:
+            sums = [np.zeros(len(self.counts))
+                    for _ in weights_for_band(0, 0)]
+
+        return [s[self.identifiers] for s in sums]
+
+    def _cached(self, name, func):
+        if name not in self._cache:
+            self._cache[name] = func()
+        return self._cache[name]
+
+    def _lookup(self, values):
+        """Return an array indexed by label, from values per cell."""
+        table = np.zeros(len(self.counts), dtype=values.dtype)
+        table[self.identifiers] = values
+        return table
+
+    def identifier(self):
+        return self.identifiers
+
+    def area(self):
+        return self.counts[self.identifiers]
+
+    def _row_offsets(self, start, stop):
+        """Return the row of each pixel in the band as an array of the shape
+        of the band."""
+        rows = np.arange(start, stop, dtype=np.double)[:, None]
+        return np.repeat(rows, self.labels.shape[1], axis=1)
+
+    def _col_offsets(self, start, stop):
+        """Return the column of each pixel in the band as an array of the
+        shape of the band."""
+        cols = np.arange(self.labels.shape[1], dtype=np.double)[None, :]
+        return np.repeat(cols, stop - start, axis=0)
+
+    def centroid_row(self):
+        def compute():
+            sums, = self._label_sums(
+                lambda start, stop: [self._row_offsets(start, stop)]
+            )
+            return sums / self.area()
+        return self._cached('centroid_row', compute)
+
+    def centroid_col(self):
+        def compute():
+            sums, = self._label_sums(
+                lambda start, stop: [self._col_offsets(start, stop)]
+            )
+            return sums / self.area()
+        return self._cached('centroid_col', compute)
+
+    def _axis_lengths(self):
+        """Return the major and minor axis lengths of the ellipses with the
+        same normalised second central moments as the cells."""
+
+        def compute():
+            row_lookup = self._lookup(self.centroid_row())
+            col_lookup = self._lookup(self.centroid_col())
+
+            def central_moments(start, stop):
+                labels = self.labels[start:stop]
+                drows = self._row_offsets(start, stop)
+                drows -= row_lookup[labels]
+                dcols = self._col_offsets(start, stop)
+                dcols -= col_lookup[labels]
+                return [drows * drows, drows * dcols, dcols * dcols]
+
+            area = self.area()
+            a, b, c = [s / area for s in self._label_sums(central_moments)]
+
+            common = np.sqrt(4 * b * b + (a - c) ** 2) / 2
+            l1 = (a + c) / 2 + common
+            l2 = np.maximum((a + c) / 2 - common, 0)
+
+            return 4 * np.sqrt(l1), 4 * np.sqrt(l2)
+
+        return self._cached('axis_lengths', compute)
+
+    def length(self):
+        major, _ = self._axis_lengths()
+        return major.astype(int)
+
+    def width(self):
+        _, minor = self._axis_lengths()
+        return minor.astype(int)
+
+    def perimeter(self):
+        """Return skimage's 4-connectivity perimeter estimate of each cell."""
+        nrows = self.labels.shape[0]
+
+        def band_weights(start, stop):
+            # The weight of a pixel depends on the pixels up to two rows
+            # away, so each band is computed with two rows of context.
+            first = max(start - 2, 0)
+            last = min(stop + 2, nrows)
+            weights = perimeter_weights(self.labels[first:last])
+            return [weights[start - first:stop - first]]
+
+        sums, = self._label_sums(band_weights)
+        return sums
+
+    def convex_area(self):
+        """Return the area of the convex hull of each cell.
+
+        The convex hulls are computed from the bounding box of each cell, so
+        this is the most expensive column.
+        """
+        slices = find_objects(self.labels)
+
+        convex_areas = np.zeros(len(self.identifiers), dtype=int)
+        for i, identifier in enumerate(self.identifiers):
+            cell = self.labels[slices[identifier - 1]] == identifier
+            convex_areas[i] = np.sum(convex_hull_image(cell))
+
+        return convex_areas
+
+
+def parameterise_cells(segmentation, columns=COLUMNS):
+    """Return measurements of the cells in the segmentation as an ordered
+    dictionary of arrays keyed by column name.
+
+    :param segmentation: labelled image
+    :param columns: names of the columns to compute
+    """
+
+    unknown = set(columns) - set(COLUMNS)
+    if unknown:
+        raise ValueError(
+            "Unknown columns: {}".format(', '.join(sorted(unknown)))
+        )
+
+    measurer = CellMeasurer(segmentation)
+
+    cell_info = OrderedDict()
+    for name in columns:
+        cell_info[name] = getattr(measurer, name)()
+
+    return cell_info
@@ -0,0 +1,153 @@
+"""Local index of the input items that have outputs in an Azure dataset.
+
+Each output item records the identifier of the input item it came from in
+its 'from' metadata. Listing the blobs of the output dataset with their
+metadata gives all of these in a few paged requests, rather than one request
+per item. The index is kept in a local JSON file. Refreshing it lists just
+the blob names and etags, and only fetches the metadata of blobs that are
+new or have changed since the last refresh. If there are many of those it
+lists all of the metadata again instead.
+"""
+
+import os
+import json
+
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+BULK_REFRESH_THRESHOLD = 100
+
+
+def input_identifier(from_value):
+    """Return the identifier of the input item in 'from' metadata.
+
+    SmartTool records the input as "<dataset uuid>/<identifier>", while
+    seedcellsize.py records just the identifier.
+    """
+
+    return from_value.rsplit('/', 1)[-1]
+
+
+class CompletionIndex(object):
+
+    def __init__(self, blob_service, container_name, fpath=None):
+        self.blob_service = blob_service
+        self.container_name = container_name
+        self.fpath = fpath
+        # Blob name -> [etag, identifier of the input item or None]
+        self.entries = {}
+
+    @classmethod
+    def from_output_dataset(cls, output_dataset, fpath=None):
+        """Return the index for an AzureProtoDataSet, loading the entries
+        cached in fpath, if any."""
+
+        index = cls(
+            output_dataset._storage_broker._blobservice,
+            output_dataset.uuid,
+            fpath
+        )
+        index.load()
+
+        return index
+
+    def load(self):
+        if self.fpath is None or not os.path.isfile(self.fpath):
+            return
+
+        with open(self.fpath) as fh:
+            data = json.load(fh)
+
+        # Ignore an index of another dataset.
+        if data['container_name'] == self.container_name:
+            self.entries = data['entries']
+
+    def save(self):
+        if self.fpath is None:
+            return
+
+        tmp_fpath = self.fpath + '.tmp'
+        with open(tmp_fpath, 'w') as fh:
+            json.dump(
+                dict(container_name=self.container_name, entries=self.entries),
+                fh
+            )
+        os.rename(tmp_fpath, self.fpath)
+
+    def _list_blobs(self, include=None):
+        return self.blob_service.list_blobs(
+            self.container_name,
+            include=include
+        )
+
+    def _fetch_entry(self, blob_name):
+        blob = self.blob_service.get_blob_properties(
+            self.container_name,
+            blob_name
+        )
+        return [blob.properties.etag, blob.metadata.get('from')]
+
+    def refresh(self, workers=8):
+        """Bring the index up to date with the blobs in the dataset, and save
+        it."""
+
+        if not self.entries:
+            self._bulk_refresh()
+            self.save()
+            return
+
+        etags = dict(
+            (blob.name, blob.properties.etag) for blob in self._list_blobs()
+        )
+
+        stale = [
+            name for name, etag in etags.items()
+            if name not in self.entries or self.entries[name][0] != etag
+        ]
+
+        if len(stale) > BULK_REFRESH_THRESHOLD:
+            self._bulk_refresh()
+            self.save()
+            return
+
+        pool = ThreadPool(workers)
+        try:
+            fetched = pool.map(self._fetch_entry, stale)
+        finally:
+            pool.close()
+            pool.join()
+
+        entries = dict(
+            (name, entry) for name, entry in self.entries.items()
+            if name in etags
+        )
+        entries.update(zip(stale, fetched))
+        self.entries = entries
+
+        self.save()
+
+    def _bulk_refresh(self):
+        self.entries = dict(
+            (blob.name, [blob.properties.etag, blob.metadata.get('from')])
+            for blob in self._list_blobs(include='metadata')
+        )
+
+    def output_counts(self):
+        """Return the number of output items of each input item."""
+
+        counts = defaultdict(int)
+        for _, from_identifier in self.entries.values():
+            if from_identifier is not None:
+                counts[input_identifier(from_identifier)] += 1
+
+        return counts
+
+    def completed_identifiers(self, min_outputs=1):
+        """Return the set of input items with at least min_outputs output
+        items."""
+
+        return set(
+            identifier
+            for identifier, count in self.output_counts().items()
+            if count >= min_outputs
+        )
@@ -1,13 +1,31 @@
 """Helper functions for working with datasets."""
 
 import os
+import time
 import shutil
 import tempfile
+import threading
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 TMPDIR_PREFIX = os.path.expanduser('~/tmp')
 
+STAGING_WORKERS = 4
+STAGING_RETRIES = 3
+
+PREFETCH = 2
+PENDING_UPLOADS = 2
+
+_overlays = {}
+_overlays_lock = threading.Lock()
+
 
 @contextmanager
 def temp_working_dir():
@@ -19,6 +37,59 @@ def temp_working_dir():
         shutil.rmtree(working_dir)
 
 
+def cached_overlay(dataset, overlay_name):
+    """Return an overlay of the dataset, fetching it only once per process.
+
+    Overlays are cached by dataset UUID and overlay name, because every item
+    staged from a dataset needs the same overlays. Frozen datasets do not
+    change, so the cache is never invalidated and lasts as long as the
+    process.
+    """
+
+    key = (dataset.uuid, overlay_name)
+
+    with _overlays_lock:
+        if key not in _overlays:
+            # dtoolcore datasets have get_overlay, dtool_azure's
+            # AzureDataSet has access_overlay instead.
+            get_overlay = getattr(dataset, 'get_overlay', None)
+            if get_overlay is None:
+                get_overlay = dataset.access_overlay
+            _overlays[key] = get_overlay(overlay_name)
+
+        return _overlays[key]
+
+
+def with_retries(func, *args, **kwargs):
+    """Call func, retrying it up to STAGING_RETRIES times if it raises,
+    waiting longer before each attempt."""
+
+    for attempt in range(STAGING_RETRIES):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            print("Retrying {} after error: {}".format(func.__name__, e))
+            time.sleep(2 ** attempt)
+
+    return func(*args, **kwargs)
+
+
+def map_in_threads(func, items, workers=STAGING_WORKERS):
+    """Return [func(item) for item in items], calling func for up to workers
+    items at once in threads, and raising the first error."""
+
+    items = list(items)
+    if len(items) < 2:
+        return [func(item) for item in items]
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def stage_outputs(
     outputs,
     working_dir,
@@ -27,22 +98,100 @@ def stage_outputs(
     overlays_to_copy,
     identifier
 ):
+    """Put the output files in the output dataset, along with their metadata.
+
+    The files are uploaded concurrently. Each file's metadata is added in
+    turn by the thread that uploaded it, as adding metadata to an item
+    rewrites all of its metadata on some storage backends.
+    """
+
+    useful_name = cached_overlay(dataset, 'useful_name')[identifier]
 
-    for filename, metadata in outputs:
+    # Add 'from' overlay, then copy overlays.
+    item_metadata = [('from', identifier)]
+    for overlay_name in overlays_to_copy:
+        value = cached_overlay(dataset, overlay_name)[identifier]
+        item_metadata.append((overlay_name, value))
+
+    def stage(output):
+        filename, metadata = output
         src_abspath = os.path.join(working_dir, filename)
-        useful_name = dataset.get_overlay('useful_name')[identifier]
         relpath = os.path.join(useful_name, filename)
         print("Push {} as {}.".format(src_abspath, relpath))
-        output_dataset.put_item(src_abspath, relpath)
+        with_retries(output_dataset.put_item, src_abspath, relpath)
+
+        # Add extra metadata
+        for k, v in item_metadata + list(metadata.items()):
+            with_retries(output_dataset.add_item_metadata, relpath, k, v)
 
-        # Add 'from' overlay
-        output_dataset.add_item_metadata(relpath, 'from', identifier)
+    map_in_threads(stage, outputs)
 
-        # Copy overlays
-        for overlay_name in overlays_to_copy:
-            value = dataset.get_overlay(overlay_name)[identifier]
-            output_dataset.add_item_metadata(relpath, overlay_name, value)
 
-        # Add extra metadata
-        for k, v in metadata.items():
-            output_dataset.add_item_metadata(relpath, k, v)
+def run_pipeline(items, fetch, compute, upload, prefetch=PREFETCH,
+                 pending_uploads=PENDING_UPLOADS):
+    """Process the items in three overlapping stages.
+
+    fetch(item) runs in a background thread, up to prefetch items ahead of
+    compute(item, fetched), which runs in the calling thread. Its results
+    are passed to upload(item, computed) in another background thread, with
+    at most pending_uploads items waiting. The bounded queues between the
+    stages cap the number of items on disk at once.
+
+    An error in any stage is reported and the item dropped, and the other
+    items carry on.
+
+    :returns: list of (item, exception) tuples for the items that failed
+    """
+
+    failures = []
+    done = object()
+
+    fetched_queue = queue.Queue(maxsize=prefetch)
+    upload_queue = queue.Queue(maxsize=pending_uploads)
+
+    def failed(item, e):
+        traceback.print_exc()
+        failures.append((item, e))
+
+    def fetcher():
+        for item in items:
+            try:
+                fetched_queue.put((item, fetch(item)))
+            except Exception as e:
+                failed(item, e)
+        fetched_queue.put(done)
+
+    def uploader():
+        while True:
+            entry = upload_queue.get()
+            if entry is done:
+                return
+            item, computed = entry
+            try:
+                upload(item, computed)
+            except Exception as e:
+                failed(item, e)
+
+    threads = [
+        threading.Thread(target=fetcher),
+        threading.Thread(target=uploader)
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    while True:
+        entry = fetched_queue.get()
+        if entry is done:
+            break
+        item, fetched = entry
+        try:
+            upload_queue.put((item, compute(item, fetched)))
+        except Exception as e:
+            failed(item, e)
+
+    upload_queue.put(done)
+    for thread in threads:
+        thread.join()
+
+    return failures
@@ -0,0 +1,174 @@
+"""Enqueue the items of a dataset as tasks for worker.py."""
+
+import json
+import hashlib
+
+import click
+import redis
+
+from dtoolcore import DataSet
+
+from worker import task_identifiers, task_priority
+
+
+def sort_by_size(identifiers, sizes):
+    """Return the identifiers ordered from the largest item to the smallest,
+    so that items of similar sizes are grouped together."""
+
+    return sorted(identifiers, key=lambda i: (-sizes[i], i))
+
+
+def group_identifiers(identifiers, group_size):
+    """Yield lists of up to group_size identifiers."""
+
+    for i in range(0, len(identifiers), group_size):
+        yield identifiers[i:i + group_size]
+
+
+def task_identifier_for(identifiers):
+    """Return a task identifier that is stable across runs of the producer, so
+    that enqueueing the same items again overwrites their task in the tasks
+    hash rather than adding another."""
+
+    if len(identifiers) == 1:
+        return identifiers[0]
+
+    joined = ','.join(identifiers).encode('utf-8')
+
+    return hashlib.sha1(joined).hexdigest()
+
+
+def identifiers_in_tasks(r, task_keys):
+    """Return the set of item identifiers in the tasks."""
+
+    if not task_keys:
+        return set()
+
+    identifiers = set()
+    for raw_task in r.hmget('tasks', task_keys):
+        if raw_task is None:
+            continue
+        task = json.loads(raw_task)
+        identifiers.update(task_identifiers(task))
+
+    return identifiers
+
+
+def completed_identifiers(r):
+    """Return the set of item identifiers in completed tasks."""
+
+    return identifiers_in_tasks(r, r.lrange('completed', 0, -1))
+
+
+def pending_identifiers(r):
+    """Return the set of item identifiers in tasks that are queued or in
+    progress."""
+
+    pending_tasks = (
+        r.zrange('workqueue', 0, -1) + r.lrange('inprogress', 0, -1)
+    )
+
+    return identifiers_in_tasks(r, pending_tasks)
+
+
+def enqueue_tasks(r, tasks, batch_size=1000):
+    """Write the tasks to the tasks hash and the workqueue sorted set, scored
+    by their priorities, sending the commands to Redis in pipelined batches
+    of batch_size tasks."""
+
+    pipe = r.pipeline(transaction=False)
+
+    batch = []
+    for task_identifier, task in tasks:
+        pipe.hset('tasks', task_identifier, json.dumps(task))
+        batch.append((task_identifier, task_priority(task)))
+
+        if len(batch) == batch_size:
+            pipe.zadd('workqueue', dict(batch))
+            pipe.execute()
+            batch = []
+
+    if batch:
+        pipe.zadd('workqueue', dict(batch))
+        pipe.execute()
+
+
+@click.command()
+@click.argument('dataset-uri')
+@click.argument('output-dataset-uri')
+@click.option('--redis-host', envvar='REDIS_HOST')
+@click.option('--tool-path', default='/scripts/seedcellsize.py',
+              help='Path to the tool run by the workers')
+@click.option('--group-size', type=int, default=1,
+              help='Number of identifiers per task')
+@click.option('--batch-size', type=int, default=1000,
+              help='Number of tasks per pipelined batch')
+@click.option('--skip-completed', is_flag=True,
+              help='Skip items in tasks that have already been completed')
+@click.option('--identifiers', 'identifiers_file', type=click.File('r'),
+              default=None,
+              help='Only enqueue the items listed in this file, one per line '
+                   "('-' to read from stdin), e.g. from find_uncompleted.py")
+def main(
+    dataset_uri,
+    output_dataset_uri,
+    redis_host,
+    tool_path,
+    group_size,
+    batch_size,
+    skip_completed,
+    identifiers_file
+):
+    r = redis.StrictRedis(host=redis_host, port=6379)
+
+    dataset = DataSet.from_uri(dataset_uri)
+    identifiers = dataset.identifiers
+
+    if identifiers_file is not None:
+        selected = set(line.strip() for line in identifiers_file)
+        identifiers = [i for i in identifiers if i in selected]
+
+    if skip_completed:
+        completed = completed_identifiers(r)
+        identifiers = [i for i in identifiers if i not in completed]
+
+    # Items that are already queued or being processed would otherwise be
+    # processed again.
+    pending = pending_identifiers(r)
+    num_selected = len(identifiers)
+    identifiers = [i for i in identifiers if i not in pending]
+
+    sizes = dict(
+        (i, dataset.item_properties(i)['size_in_bytes']) for i in identifiers
+    )
+    identifiers = sort_by_size(identifiers, sizes)
+
+    def build_task(group):
+        task = dict(
+            tool_path=tool_path,
+            input_uuid=dataset_uri,
+            identifier=group[0],
+            output_uuid=output_dataset_uri,
+            size_in_bytes=sum(sizes[i] for i in group)
+        )
+        if len(group) > 1:
+            task['identifiers'] = group
+        return task_identifier_for(group), task
+
+    tasks = [
+        build_task(group)
+        for group in group_identifiers(identifiers, group_size)
+    ]
+
+    enqueue_tasks(r, tasks, batch_size)
+
+    print("Enqueued {} items in {} tasks, skipping {} already queued or in "
+          "progress".format(
+              len(identifiers),
+              len(tasks),
+              num_selected - len(identifiers)
+          ))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,28 @@
-"""Identify unprocessed identifiers."""
+"""Identify unprocessed identifiers.
+
+The identifiers of the input items that have not been processed are written
+one per line, ready to pass to enqueue_tasks.py --identifiers.
+"""
 
 import yaml
 import click
 
 from dtool_azure import AzureDataSet, AzureProtoDataSet
 
+from completionindex import CompletionIndex
+
 
 @click.command()
 @click.option('--config-path')
-def main(config_path=None):
+@click.option('--index-file', default='completion_index.json',
+              help='Local cache of the completion index')
+@click.option('--min-outputs', type=int, default=1,
+              help='Number of output items an input item needs to count as '
+                   'completed')
+@click.option('--output', type=click.File('w'), default='-',
+              help='File to write the uncompleted identifiers to '
+                   '(default: stdout)')
+def main(config_path, index_file, min_outputs, output):
 
     with open('analysis.yml') as fh:
         analyis_config = yaml.load(fh)
@@ -21,18 +35,25 @@ def main(config_path=None):
 
     input_identifiers = set(input_dataset.identifiers)
 
-    completed_identifers = set([
-        output_dataset._item_metadata(identifier)['from']
-        for identifier in output_dataset._iteridentifiers()
-    ])
+    index = CompletionIndex.from_output_dataset(output_dataset, index_file)
+    index.refresh()
+
+    completed_identifers = (
+        index.completed_identifiers(min_outputs) & input_identifiers
+    )
 
     uncompleted_identififers = input_identifiers - completed_identifers
 
-    print("Completed {} of {}".format(
+    for identifier in sorted(uncompleted_identififers):
+        output.write(identifier + '\n')
+
+    click.echo("Completed {} of {}".format(
         len(completed_identifers),
         len(input_identifiers)
-        )
+        ),
+        err=True
     )
 
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,142 @@
+"""Opt-in instrumentation of the analysis pipeline.
+
+Functions decorated with :func:`instrumented`, and blocks of code wrapped in
+:func:`measure`, record their wall time, the CPU time of the thread running
+them, peak resident set size above that at the start of the call, and the
+shape and dtype of their input and output images. Nothing is recorded unless
+recording has been started, so the instrumentation costs next to nothing when
+it is not in use.
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+
+from functools import wraps
+from contextlib import contextmanager
+
+from memusage import PeakMemorySampler
+
+_records = None
+_memory = None
+
+# Python 2 does not define RUSAGE_THREAD, although Linux supports it.
+RUSAGE_THREAD = getattr(
+    resource,
+    'RUSAGE_THREAD',
+    1 if sys.platform.startswith('linux') else None
+)
+
+
+def start_recording():
+    """Start recording measurements, discarding any previous ones."""
+    global _records, _memory
+
+    if _memory is None:
+        _memory = PeakMemorySampler()
+    _records = []
+
+
+def stop_recording():
+    """Stop recording and return the measurements."""
+    global _records
+
+    records = _records
+    _records = None
+
+    return records
+
+
+def is_recording():
+    return _records is not None
+
+
+def describe_array(prefix, value):
+    """Return the shape and dtype of an array as a dictionary."""
+
+    if not hasattr(value, 'shape') or not hasattr(value, 'dtype'):
+        return {}
+
+    return {
+        prefix + '_shape': list(value.shape),
+        prefix + '_dtype': str(value.dtype),
+    }
+
+
+def _cpu_time():
+    """Return the name of the CPU time measured and its current value.
+
+    Where possible this is the CPU time of the calling thread, so that work
+    done at the same time by other threads, such as the background PNG
+    writers, is not counted. Otherwise it is the CPU time of the process.
+    """
+
+    if RUSAGE_THREAD is not None:
+        usage = resource.getrusage(RUSAGE_THREAD)
+        return 'cpu_time', usage.ru_utime + usage.ru_stime
+
+    times = os.times()
+    return 'process_cpu_time', times[0] + times[1]
+
+
+@contextmanager
+def measure(name, **info):
+    """Record measurements of the code run in the context.
+
+    The context yields a dictionary to which further information about the
+    call, such as the shape of its output, can be added.
+    """
+
+    if not is_recording():
+        yield {}
+        return
+
+    record = dict(name=name)
+    record.update(info)
+
+    token, start_rss = _memory.start()
+    cpu_name, start_cpu = _cpu_time()
+    start = time.time()
+    record['start_time'] = start
+
+    try:
+        yield record
+    finally:
+        record['wall_time'] = time.time() - start
+        record[cpu_name] = _cpu_time()[1] - start_cpu
+        record['peak_rss_delta_bytes'] = _memory.stop(token) - start_rss
+
+        if is_recording():
+            _records.append(record)
+
+
+def instrumented(func):
+    """Decorator recording measurements of each call of the function, when
+    recording, including the shape and dtype of its first argument and of its
+    return value."""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not is_recording():
+            return func(*args, **kwargs)
+
+        info = describe_array('input', args[0] if args else None)
+        with measure(func.__name__, **info) as record:
+            result = func(*args, **kwargs)
+            record.update(describe_array('output', result))
+
+        return result
+
+    return wrapper
+
+
+def write_records(records, fpath, **info):
+    """Write the measurements to a JSON file."""
+
+    data = dict(info)
+    data['records'] = records
+
+    with open(fpath, 'w') as fh:
+        json.dump(data, fh, indent=2)
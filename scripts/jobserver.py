@@ -0,0 +1,73 @@
+"""Run the jobs of a tool script in one long-lived process.
+
+The tool script is imported once. Each line read from stdin is a JSON job
+giving the command line arguments of one run of the tool, for example::
+
+    {"id": "abc", "args": ["-i", "/scratch/abc/input1", "-o", "/scratch/abc"]}
+
+The job is run by calling the tool's main function with those arguments, and
+its status is written to stdout as a line of JSON::
+
+    {"id": "abc", "status": "ok", "wall_time": 12.3}
+
+Anything the tool itself prints goes to stderr, so that stdout only carries
+the job statuses. The server exits when stdin is closed.
+
+Usage: python jobserver.py /scripts/analysis.py
+"""
+
+import os
+import sys
+import json
+import time
+import traceback
+
+from toolloader import load_tool
+
+
+def run_job(tool, tool_path, args):
+    """Run the tool's main function with the command line arguments."""
+
+    sys.argv = [tool_path] + list(args)
+
+    try:
+        tool.main()
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            raise RuntimeError("Exited with status {}".format(e.code))
+
+
+def main():
+    tool_path = sys.argv[1]
+
+    # Keep stdout for the job statuses, sending all other output to stderr.
+    statuses = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    tool = load_tool(tool_path)
+
+    for line in iter(sys.stdin.readline, ''):
+        if not line.strip():
+            continue
+
+        job = json.loads(line)
+        status = dict(id=job.get('id'))
+
+        start = time.time()
+        try:
+            run_job(tool, tool_path, job['args'])
+            status['status'] = 'ok'
+        except Exception as e:
+            traceback.print_exc()
+            status['status'] = 'failed'
+            status['error'] = "{}: {}".format(type(e).__name__, e)
+        status['wall_time'] = time.time() - start
+
+        sys.stdout.flush()
+        statuses.write(json.dumps(status) + '\n')
+        statuses.flush()
+
+
+if __name__ == '__main__':
+    main()
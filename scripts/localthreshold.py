@@ -0,0 +1,130 @@
+"""Local thresholding backends.
+
+The 'gaussian' method is skimage's threshold_adaptive, which compares each
+pixel to a gaussian weighted local mean. Its cost grows with the block size.
+The other methods compute local means with box filters, using integral images
+(cumulative sums), and so cost the same whatever the block size. For integer
+images the sums are exact, so the result does not depend on where the image
+starts, e.g. when it is processed in tiles.
+
+- 'mean' compares each pixel to the mean of the block_size by block_size
+  block around it (skimage's 'mean' method).
+- 'box_gaussian' approximates the gaussian weighted local mean with three
+  successive box filters, giving close to the same result as 'gaussian'.
+
+Run this module on some images to check how closely a method agrees with
+the 'gaussian' method.
+"""
+
+import math
+
+import click
+import numpy as np
+
+import skimage.filters
+
+METHODS = ['gaussian', 'mean', 'box_gaussian']
+
+
+def box_sizes_for_gaussian(sigma, passes=3):
+    """Return the odd widths of the box filters whose successive application
+    best approximates a gaussian filter with standard deviation sigma."""
+
+    ideal = math.sqrt(12.0 * sigma * sigma / passes + 1)
+    lower = int(math.floor(ideal))
+    if lower % 2 == 0:
+        lower -= 1
+    upper = lower + 2
+
+    num_lower = int(round(
+        (12 * sigma * sigma - passes * lower * lower - 4 * passes * lower -
+         3 * passes) / (-4.0 * lower - 4)
+    ))
+
+    return [lower if i < num_lower else upper for i in range(passes)]
+
+
+def box_sum(image, size, axis):
+    """Return the sums over windows of size pixels centred on each pixel
+    along an axis, reflecting the image at its edges."""
+
+    radius = size // 2
+    padding = [(0, 0)] * image.ndim
+    padding[axis] = (radius, radius)
+    padded = np.pad(image, padding, mode='symmetric')
+
+    zeros_shape = list(padded.shape)
+    zeros_shape[axis] = 1
+    integral = np.concatenate(
+        [np.zeros(zeros_shape, dtype=padded.dtype), padded.cumsum(axis=axis)],
+        axis=axis
+    )
+
+    length = image.shape[axis]
+    upper = integral.take(np.arange(size, size + length), axis=axis)
+    lower = integral.take(np.arange(0, length), axis=axis)
+
+    return upper - lower
+
+
+def local_threshold(image, block_size=91, method='gaussian'):
+    """Return a boolean image of the pixels above their local mean.
+
+    :param image: 2D grayscale image
+    :param block_size: odd size of the neighbourhood of each pixel
+    :param method: one of METHODS
+    """
+
+    if method == 'gaussian':
+        return skimage.filters.threshold_adaptive(image, block_size)
+
+    image = np.asarray(image)
+    if np.issubdtype(image.dtype, np.integer):
+        image = image.astype(np.int64)
+    else:
+        image = image.astype(np.double)
+
+    if method == 'mean':
+        sizes = [block_size]
+    elif method == 'box_gaussian':
+        # Same sigma as skimage uses for the gaussian method.
+        sizes = box_sizes_for_gaussian((block_size - 1) / 6.0)
+    else:
+        raise ValueError("Unknown threshold method: {}".format(method))
+
+    # Compare each pixel to the local mean, without dividing the sums so
+    # that the comparison is exact for integer images.
+    local_sum = image
+    normalisation = 1
+    for size in sizes:
+        local_sum = box_sum(box_sum(local_sum, size, 0), size, 1)
+        normalisation *= size * size
+
+    return image * normalisation > local_sum
+
+
+def threshold_agreement(image, block_size=91, method='box_gaussian'):
+    """Return the fraction of pixels thresholded the same way by the method
+    and the 'gaussian' method."""
+
+    reference = local_threshold(image, block_size, 'gaussian')
+    thresholded = local_threshold(image, block_size, method)
+
+    return np.mean(reference == thresholded)
+
+
+@click.command()
+@click.argument('image-files', nargs=-1)
+@click.option('--method', type=click.Choice(METHODS), default='box_gaussian')
+@click.option('--block-size', type=int, default=91)
+def main(image_files, method, block_size):
+    from jicbioimage.core.image import Image
+
+    for fpath in image_files:
+        image = Image.from_file(fpath)
+        agreement = threshold_agreement(image, block_size, method)
+        print("{}: {:.4%} of pixels agree".format(fpath, agreement))
+
+
+if __name__ == '__main__':
+    main()
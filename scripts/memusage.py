@@ -0,0 +1,74 @@
+"""Measure the memory use of the running process."""
+
+import time
+import resource
+import threading
+
+PAGE_SIZE = resource.getpagesize()
+
+
+def current_rss():
+    """Return the resident set size of the process in bytes.
+
+    Reads /proc/self/statm where available, falling back to the peak resident
+    set size reported by getrusage on other platforms.
+    """
+
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * PAGE_SIZE
+    except IOError:
+        # ru_maxrss is in kilobytes on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakMemorySampler(object):
+    """Track the peak resident set size of the process over intervals, which
+    may be nested, by sampling it in a background thread.
+
+    The thread only samples while an interval is open.
+    """
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self._peaks = {}
+        self._next_token = 0
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            self._active.wait()
+            self.sample()
+            time.sleep(self.interval)
+
+    def sample(self):
+        rss = current_rss()
+        with self._lock:
+            for token, peak in self._peaks.items():
+                self._peaks[token] = max(peak, rss)
+        return rss
+
+    def start(self):
+        """Start an interval, returning a token to end it with and the
+        resident set size at its start."""
+        rss = current_rss()
+        with self._lock:
+            token = self._next_token
+            self._next_token += 1
+            self._peaks[token] = rss
+            self._active.set()
+        return token, rss
+
+    def stop(self, token):
+        """End an interval, returning the peak resident set size during it."""
+        self.sample()
+        with self._lock:
+            peak = self._peaks.pop(token)
+            if not self._peaks:
+                self._active.clear()
+        return peak
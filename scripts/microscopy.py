@@ -0,0 +1,167 @@
+"""Streaming access to the series of multi-series microscopy files.
+
+Containers such as Leica LIF files hold many images, one per series. Rather
+than converting the container into a dataset of images up front, a single
+Bio-Formats bfconvert process opens the container once and writes one plane
+of each series to a temporary file in turn. Each plane is read and its file
+removed as soon as it is complete, so that only one plane is held in memory
+at once, and each series can be analysed while the next ones are extracted.
+bfconvert is paused while MAX_AHEAD converted planes are waiting to be read,
+so that it never gets far ahead of the analysis.
+"""
+
+import os
+import time
+import errno
+import shutil
+import signal
+import tempfile
+import threading
+import subprocess
+
+from jicbioimage.core.image import Image
+
+CONTAINER_EXTENSIONS = ['.lif', '.lsm', '.czi', '.nd2']
+
+POLL_INTERVAL = 0.1
+
+# Number of converted planes that may wait to be read before bfconvert is
+# paused. Must be at least 1.
+MAX_AHEAD = 2
+
+
+class ConversionError(Exception):
+    """Raised when bfconvert fails before converting every series."""
+
+    def __init__(self, series, message):
+        super(ConversionError, self).__init__(message)
+        self.series = series
+
+
+def is_container(fpath):
+    """Return True if the file is a multi-series microscopy container."""
+
+    _, ext = os.path.splitext(fpath)
+
+    return ext.lower() in CONTAINER_EXTENSIONS
+
+
+def signal_group(process, signum):
+    """Send a signal to the process group of the process, ignoring groups
+    that have already gone."""
+
+    try:
+        os.killpg(process.pid, signum)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+def throttle(process, tmpdir, done):
+    """Pause the process group while more than MAX_AHEAD files are in the
+    directory, one of which may still be being written, and continue it
+    once some have been read, until done is set.
+
+    The process is only polled by the thread reading the planes, so that
+    its exit status is not lost.
+    """
+
+    paused = False
+    while not done.wait(POLL_INTERVAL):
+        waiting = len(os.listdir(tmpdir))
+        if not paused and waiting > MAX_AHEAD:
+            signal_group(process, signal.SIGSTOP)
+            paused = True
+        elif paused and waiting <= MAX_AHEAD:
+            signal_group(process, signal.SIGCONT)
+            paused = False
+
+    if paused:
+        signal_group(process, signal.SIGCONT)
+
+
+def iter_series(fpath, channel=0, zslice=0, timepoint=0):
+    """Yield (series, image) tuples for each series of the container.
+
+    Planes are extracted in the background by one bfconvert process, which
+    writes one file per series. The file of a series is complete once the
+    file of a later series has been started, or bfconvert has finished.
+
+    :raises: ConversionError if bfconvert fails, after yielding the series
+             converted before the failure
+    """
+
+    tmpdir = tempfile.mkdtemp()
+
+    def plane_fpath(series):
+        return os.path.join(tmpdir, 'series_{}.tif'.format(series))
+
+    command = [
+        'bfconvert', '-no-upgrade',
+        '-channel', str(channel),
+        '-z', str(zslice),
+        '-timepoint', str(timepoint),
+        fpath,
+        os.path.join(tmpdir, 'series_%s.tif')
+    ]
+    # In its own process group, so that the JVM started by the bfconvert
+    # script is paused and killed along with it.
+    process = subprocess.Popen(command, preexec_fn=os.setsid)
+
+    done = threading.Event()
+    throttler = threading.Thread(
+        target=throttle,
+        args=(process, tmpdir, done)
+    )
+    throttler.daemon = True
+    throttler.start()
+
+    try:
+        series = 0
+        while True:
+            # bfconvert writes the series in order, so the plane of a series
+            # is complete once any other file has been started.
+            while len(os.listdir(tmpdir)) < 2 and process.poll() is None:
+                time.sleep(POLL_INTERVAL)
+
+            if not os.path.isfile(plane_fpath(series)):
+                if os.listdir(tmpdir):
+                    raise ConversionError(
+                        series,
+                        "bfconvert wrote no plane for series {}".format(
+                            series
+                        )
+                    )
+                if process.returncode != 0:
+                    raise ConversionError(
+                        series,
+                        "bfconvert exited with status {} before series "
+                        "{}".format(process.returncode, series)
+                    )
+                return
+
+            if len(os.listdir(tmpdir)) < 2 and process.returncode != 0:
+                raise ConversionError(
+                    series,
+                    "bfconvert exited with status {} before finishing "
+                    "series {}".format(process.returncode, series)
+                )
+
+            image = Image.from_file(plane_fpath(series))
+            os.unlink(plane_fpath(series))
+
+            yield series, image
+            series += 1
+    finally:
+        done.set()
+        throttler.join()
+        if process.poll() is None:
+            signal_group(process, signal.SIGKILL)
+            process.wait()
+        shutil.rmtree(tmpdir)
+
+
+def series_name(series):
+    """Return the name of the output directory of a series."""
+
+    return 'series_{:03d}'.format(series)
@@ -0,0 +1,155 @@
+"""Show the progress of the analysis from the task queue and worker metrics.
+
+Only Redis is read, using the queue lengths and the metrics published by
+worker.py, so this is cheap enough to run repeatedly.
+"""
+
+import time
+
+import click
+import redis
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def duration_percentiles(r, percentiles):
+    """Return the task durations at the given percentiles, or None if no
+    tasks have finished."""
+
+    count = r.zcard('metrics:durations')
+    if count == 0:
+        return [None for _ in percentiles]
+
+    durations = []
+    for percentile in percentiles:
+        rank = int(round((count - 1) * percentile / 100.0))
+        _, duration = r.zrange('metrics:durations', rank, rank,
+                               withscores=True)[0]
+        durations.append(duration)
+
+    return durations
+
+
+def collect_progress(r, window):
+    """Return a summary of the progress of the analysis, measuring throughput
+    over the last window seconds."""
+
+    now = time.time()
+    since = now - window
+
+    pipe = r.pipeline(transaction=False)
+    pipe.llen('completed')
+    pipe.llen('inprogress')
+    pipe.zcard('workqueue')
+    pipe.llen('deadletter')
+    pipe.zcount('metrics:finished', since, now)
+    pipe.hgetall('metrics:workers')
+    completed, in_progress, queued, dead, recent, workers = pipe.execute()
+
+    last_seen = dict(
+        (_text(name), float(seen)) for name, seen in workers.items()
+    )
+    names = sorted(last_seen)
+
+    pipe = r.pipeline(transaction=False)
+    for name in names:
+        pipe.zcount('metrics:finished:' + name, since, now)
+    recent_by_worker = pipe.execute()
+
+    p50, p95 = duration_percentiles(r, [50, 95])
+
+    rate = recent / float(window)
+    remaining = queued + in_progress
+
+    return dict(
+        completed=completed,
+        in_progress=in_progress,
+        queued=queued,
+        dead=dead,
+        tasks_per_minute=60 * rate,
+        p50_duration=p50,
+        p95_duration=p95,
+        eta=remaining / rate if rate > 0 else None,
+        workers=[
+            dict(
+                name=name,
+                tasks_per_minute=60 * count / float(window),
+                last_seen=now - last_seen[name]
+            )
+            for name, count in zip(names, recent_by_worker)
+        ]
+    )
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '?'
+
+    if seconds < 60:
+        return '{:.1f}s'.format(seconds)
+
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+
+    if hours:
+        return '{}h {:02d}m'.format(hours, minutes)
+    return '{}m {:02d}s'.format(minutes, seconds)
+
+
+def format_progress(progress, window):
+    lines = [
+        "Tasks: {completed} completed, {in_progress} in progress, "
+        "{queued} queued, {dead} dead".format(**progress),
+        "Throughput: {:.1f} tasks/min over the last {}".format(
+            progress['tasks_per_minute'],
+            format_duration(window)
+        ),
+        "Duration: p50 {}, p95 {}".format(
+            format_duration(progress['p50_duration']),
+            format_duration(progress['p95_duration'])
+        ),
+        "ETA: {}".format(format_duration(progress['eta'])),
+        "Workers:"
+    ]
+
+    for worker in progress['workers']:
+        lines.append("  {:<30} {:>6.1f} tasks/min, last seen {} ago".format(
+            worker['name'],
+            worker['tasks_per_minute'],
+            format_duration(worker['last_seen'])
+            )
+        )
+
+    return '\n'.join(lines)
+
+
+@click.command()
+@click.option('--redis-host', envvar='REDIS_HOST')
+@click.option('--window', type=float, default=10,
+              help='Minutes over which to measure throughput')
+@click.option('--watch', type=float, default=None,
+              help='Refresh every this many seconds')
+def main(redis_host, window, watch):
+    r = redis.StrictRedis(host=redis_host, port=6379)
+
+    window = 60 * window
+
+    while True:
+        output = format_progress(collect_progress(r, window), window)
+
+        if watch is None:
+            print(output)
+            return
+
+        click.clear()
+        print(output)
+        time.sleep(watch)
+
+
+if __name__ == '__main__':
+    main()
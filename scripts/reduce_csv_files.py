@@ -2,93 +2,406 @@
 import os
 import csv
 import json
+import hashlib
+import sqlite3
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 import click
+import numpy as np
 
 from dtoolcore import DataSet
 
 
-def identifiers_where_overlay_is_true(dataset, overlay_name):
-
-    overlay = dataset.get_overlay(overlay_name)
+EXTRA_HEADER_KEYS = ['label1', 'label2', 'label3']
 
-    selected = [identifier
-                for identifier in dataset.identifiers
-                if overlay[identifier]]
+RESULT_EXTENSIONS = ['.csv', '.npz']
 
-    return selected
 
+def result_identifiers(dataset):
+    """Return the identifiers of the result files to reduce.
 
-def create_is_csv_overlay(dataset):
+    Where an image has both a results.npz and a results.csv file only the
+    .npz file is used, as it is faster to read and keeps full precision.
+    """
 
-    def is_csv(identifier):
+    preferred = {}
+    for identifier in dataset.identifiers:
         relpath = dataset.item_properties(identifier)['relpath']
-        _, ext = os.path.splitext(relpath)
-        return ext == '.csv'
+        name, ext = os.path.splitext(relpath)
+        if ext not in RESULT_EXTENSIONS:
+            continue
+        if name not in preferred or ext == '.npz':
+            preferred[name] = identifier
 
-    is_csv_overlay = {
-        identifier: is_csv(identifier)
-        for identifier in dataset.identifiers
-    }
+    selected = set(preferred.values())
 
-    dataset.put_overlay("is_csv", is_csv_overlay)
+    return [identifier
+            for identifier in dataset.identifiers
+            if identifier in selected]
 
 
 def generate_header_list(unsorted_keys):
     """Return a list of headers for the CSV file, ensuing that the order of the
     first four headers is fixed and the remainder are sorted."""
 
-    unsorted_keys.remove('identifier')
+    fixed_keys = ['identifier'] + EXTRA_HEADER_KEYS
 
-    sorted_remainder = sorted(unsorted_keys)
+    sorted_remainder = sorted(set(unsorted_keys) - set(fixed_keys))
 
-    header_list = ['identifier', 'label1', 'label2', 'label3']
-    header_list += sorted_remainder
+    header_list = fixed_keys + sorted_remainder
 
     return header_list
 
 
-def build_master_csv(fpaths_and_extra_data, output_csv_fpath):
+def read_fieldnames(fpath):
+    """Return the column names of a CSV or .npz result file."""
+
+    if fpath.endswith('.npz'):
+        data = np.load(fpath)
+        try:
+            return list(data.files)
+        finally:
+            data.close()
+
+    with open(fpath) as fh:
+        return next(csv.reader(fh), [])
+
+
+def read_rows(fpath):
+    """Return the column names and rows of a CSV or .npz result file, as
+    lists.
+
+    The columns of .npz files are read as arrays and turned straight into
+    numbers, without going through text.
+    """
+
+    if fpath.endswith('.npz'):
+        data = np.load(fpath)
+        try:
+            fieldnames = list(data.files)
+            columns = [data[name].tolist() for name in fieldnames]
+        finally:
+            data.close()
+
+        return fieldnames, [list(row) for row in zip(*columns)]
+
+    with open(fpath) as fh:
+        reader = csv.reader(fh)
+        fieldnames = next(reader, [])
+        rows = list(reader)
+
+    return fieldnames, rows
+
+
+def iter_in_background(func, items, pool, window):
+    """Yield func(item) for each item, in order, computing up to window
+    results ahead in the thread pool."""
+
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+
+def iter_rows(header_list, fpaths_and_extra_data, pool, workers):
+    """Yield the position of each result file in the list and its rows, with
+    the extra values added, in the order of the header."""
+
+    fpaths = [fpath for fpath, _ in fpaths_and_extra_data]
+
+    contents = iter_in_background(read_rows, fpaths, pool, 4 * workers)
+    for i, (fieldnames, rows) in enumerate(contents):
+        _, extra_values = fpaths_and_extra_data[i]
+        extra_data = dict(zip(EXTRA_HEADER_KEYS, extra_values))
+        positions = dict((h, n) for n, h in enumerate(fieldnames))
+
+        # For each output column, the position of its value in the input
+        # rows, or the value to use for all rows.
+        sources = [
+            (positions[h], None) if h in positions
+            else (None, extra_data.get(h, ''))
+            for h in header_list
+        ]
+
+        # Short rows are missing their last values.
+        width = len(fieldnames)
+        rows = (row + [''] * (width - len(row)) for row in rows)
+
+        yield i, [
+            [row[n] if n is not None else value for n, value in sources]
+            for row in rows
+        ]
+
+
+class CellDatabase(object):
+    """SQLite copy of the master CSV table, with the identifier of the item
+    each row came from in an extra item column.
+
+    The item and label columns are indexed, so that selecting and grouping
+    cells by them does not need a full scan. Empty values are stored as NULL.
+    """
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.connection = sqlite3.connect(fpath)
+
+    @classmethod
+    def create(cls, fpath, header_list):
+        if os.path.isfile(fpath):
+            os.unlink(fpath)
+
+        database = cls(fpath)
+
+        columns = ['item TEXT'] + [
+            '{} {}'.format(
+                quote_identifier(h),
+                'TEXT' if h in EXTRA_HEADER_KEYS else 'NUMERIC'
+            )
+            for h in header_list
+        ]
+        database.connection.execute(
+            'CREATE TABLE cells ({})'.format(', '.join(columns))
+        )
+
+        return database
+
+    def add_rows(self, item, rows):
+        if not rows:
+            return
+
+        placeholders = ', '.join('?' * (len(rows[0]) + 1))
+        self.connection.executemany(
+            'INSERT INTO cells VALUES ({})'.format(placeholders),
+            ([item] + [v if v != '' else None for v in row] for row in rows)
+        )
+
+    def remove_items(self, items):
+        self.connection.executemany(
+            'DELETE FROM cells WHERE item = ?',
+            ([item] for item in items)
+        )
+
+    def create_indexes(self):
+        for column in ['item'] + EXTRA_HEADER_KEYS:
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS cells_{0} ON cells ({0})'.format(
+                    column
+                )
+            )
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def quote_identifier(name):
+    return '"{}"'.format(name.replace('"', '""'))
 
-    extra_header_keys = ['label1', 'label2', 'label3']
 
-    first_file_fpath = fpaths_and_extra_data[0][0]
+def union_of_fieldnames(fpaths, pool):
+    all_fieldnames = set()
+    for fieldnames in pool.imap(read_fieldnames, fpaths, chunksize=16):
+        all_fieldnames.update(fieldnames)
 
-    with open(first_file_fpath) as fh:
-        reader = csv.DictReader(fh)
-        row = reader.next()
-        header_list = generate_header_list(row.keys())
+    return all_fieldnames
 
-    with open(output_csv_fpath, 'w') as fh:
-        fh.write(','.join(header_list) + '\n')
 
-    def add_to_output_csv(list_of_items):
+def build_master_csv(fpaths_and_extra_data, output_csv_fpath, workers=8,
+                     sqlite_fpath=None, item_identifiers=None):
+    """Concatenate the result files, adding the extra values to each row.
+
+    The header is the union of the columns of all of the files; rows from
+    files without a column have it left empty. The files are read by a pool
+    of threads to hide storage latency, a few files ahead of the one being
+    written, so memory use does not grow with the number of rows.
+
+    If sqlite_fpath is given the rows are also written to a
+    :class:`CellDatabase`, along with the item identifiers of the files.
+
+    :returns: the header of the master CSV file
+    """
+
+    fpaths = [fpath for fpath, _ in fpaths_and_extra_data]
+
+    pool = ThreadPool(workers)
+    try:
+        header_list = generate_header_list(union_of_fieldnames(fpaths, pool))
+
+        database = None
+        if sqlite_fpath is not None:
+            # Build a new database alongside any existing one, and only
+            # replace it once it is complete.
+            database = CellDatabase.create(sqlite_fpath + '.tmp', header_list)
+
+        with open(output_csv_fpath, 'w') as fh:
+            writer = csv.writer(fh, lineterminator='\n')
+            writer.writerow(header_list)
+
+            for i, rows in iter_rows(header_list, fpaths_and_extra_data, pool,
+                                     workers):
+                writer.writerows(rows)
+                if database is not None:
+                    database.add_rows(item_identifiers[i], rows)
+
+        if database is not None:
+            database.create_indexes()
+            database.commit()
+            database.close()
+            os.rename(database.fpath, sqlite_fpath)
+    finally:
+        pool.close()
+        pool.join()
+
+    return header_list
+
+
+def append_to_master_csv(fpaths_and_extra_data, output_csv_fpath, header_list,
+                         workers=8, sqlite_fpath=None, item_identifiers=None):
+    """Append the rows of the result files to an existing master CSV file, and
+    to its :class:`CellDatabase` if sqlite_fpath is given.
+
+    :returns: False, without writing anything, if the files have columns
+              that are not in the header of the master CSV file
+    """
+
+    fpaths = [fpath for fpath, _ in fpaths_and_extra_data]
+
+    pool = ThreadPool(workers)
+    try:
+        if not union_of_fieldnames(fpaths, pool) <= set(header_list):
+            return False
+
+        database = None
+        if sqlite_fpath is not None:
+            database = CellDatabase(sqlite_fpath)
+            # Drop any rows left by an interrupted run.
+            database.remove_items(item_identifiers)
 
         with open(output_csv_fpath, 'a') as fh:
-            for entry in list_of_items:
-                line = ','.join(str(entry[h]) for h in header_list)
-                fh.write(line + '\n')
+            writer = csv.writer(fh, lineterminator='\n')
+
+            for i, rows in iter_rows(header_list, fpaths_and_extra_data, pool,
+                                     workers):
+                writer.writerows(rows)
+                if database is not None:
+                    database.add_rows(item_identifiers[i], rows)
+
+        if database is not None:
+            database.commit()
+            database.close()
+    finally:
+        pool.close()
+        pool.join()
+
+    return True
+
+
+def load_state(state_fpath):
+    """Return the state of an incremental reduction, or None if there is no
+    state file."""
 
-    for fpath, extra_values in fpaths_and_extra_data:
+    if not os.path.isfile(state_fpath):
+        return None
 
-        extra_data = dict(zip(extra_header_keys, extra_values))
+    with open(state_fpath) as fh:
+        return json.load(fh)
 
-        with open(fpath) as fh:
-            reader = csv.DictReader(fh)
-            all_rows = list(reader)
 
-        for items in all_rows:
-            items.update(extra_data)
+def save_state(state_fpath, state):
+    """Write the state of an incremental reduction, replacing the old state
+    file in one step."""
 
-        add_to_output_csv(all_rows)
+    tmp_fpath = state_fpath + '.tmp'
+    with open(tmp_fpath, 'w') as fh:
+        json.dump(state, fh)
+    os.rename(tmp_fpath, state_fpath)
+
+
+TAIL_LENGTH = 4096
+
+
+def tail_checksum(fpath, size):
+    """Return a checksum of the last TAIL_LENGTH bytes of the first size bytes
+    of the file, identifying the file the size was recorded for."""
+
+    with open(fpath, 'rb') as fh:
+        fh.seek(max(0, size - TAIL_LENGTH))
+        tail = fh.read(min(size, TAIL_LENGTH))
+
+    return hashlib.sha1(tail).hexdigest()
+
+
+def identifiers_to_append(state, dataset_uri, item_hashes, output_csv_fpath):
+    """Return the identifiers whose rows need appending to the master CSV
+    file, or None if it needs rebuilding from scratch.
+
+    It needs rebuilding if it was made from another dataset, if any item
+    already in it has changed or gone, or if it is not the file recorded in
+    the state: smaller than the recorded size, or with different content
+    before it. If it is larger, it is truncated back to the recorded size,
+    dropping rows written by an interrupted run.
+    """
+
+    if state is None or state['dataset_uri'] != dataset_uri:
+        return None
+
+    reduced = state['items']
+    for identifier, item_hash in reduced.items():
+        if item_hashes.get(identifier) != item_hash:
+            return None
+
+    if not os.path.isfile(output_csv_fpath):
+        return None
+    size = os.path.getsize(output_csv_fpath)
+    if size < state['size']:
+        return None
+    if tail_checksum(output_csv_fpath, state['size']) != state.get('tail'):
+        return None
+    if size > state['size']:
+        with open(output_csv_fpath, 'r+') as fh:
+            fh.truncate(state['size'])
+
+    return [i for i in sorted(item_hashes) if i not in reduced]
+
+
+def fetch_items(dataset, identifiers, workers):
+    """Return the local paths of the items' content."""
+
+    # Fetching items from remote storage is slow, so fetch several at once.
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(dataset.item_content_abspath, identifiers)
+    finally:
+        pool.close()
+        pool.join()
 
 
 @click.command()
 @click.argument('dataset-path')
-def main(dataset_path):
+@click.option('--workers', type=int, default=8,
+              help='Number of threads fetching and reading result files')
+@click.option('--incremental', is_flag=True, default=False,
+              help='Only append the rows of items not yet in all_cells.csv')
+@click.option('--state-file', default='all_cells.state.json',
+              help='File recording the items already reduced, written by '
+                   'every run and read with --incremental')
+@click.option('--sqlite', default=None,
+              help='Also write the cells to this SQLite database, indexed by '
+                   'item and labels')
+def main(dataset_path, workers, incremental, state_file, sqlite):
     dataset = DataSet.from_uri(dataset_path)
 
-    create_is_csv_overlay(dataset)
+    output_csv_fpath = 'all_cells.csv'
+
+    identifiers = result_identifiers(dataset)
 
     def info_from_identifier(identifier):
         relpath = dataset.item_properties(identifier)['relpath']
@@ -107,17 +420,70 @@ def main(dataset_path):
 
         return label1, label2, label3
 
-    fpaths_and_extra_data = [
-        (
-            dataset.item_content_abspath(identifier),
-            info_from_identifier(identifier)
+    def fpaths_and_extra_data_for(identifiers):
+        fpaths = fetch_items(dataset, identifiers, workers)
+        return [
+            (fpath, info_from_identifier(identifier))
+            for fpath, identifier in zip(fpaths, identifiers)
+        ]
+
+    item_hashes = {
+        identifier: dataset.item_properties(identifier)['hash']
+        for identifier in identifiers
+    }
+
+    state = None
+    new_identifiers = None
+    if incremental:
+        state = load_state(state_file)
+        new_identifiers = identifiers_to_append(
+            state,
+            dataset.uri,
+            item_hashes,
+            output_csv_fpath
+        )
+        # The database has to be rebuilt along with the CSV file if it is
+        # not the one that has been kept up to date.
+        if new_identifiers is not None and sqlite is not None and (
+            state.get('sqlite') != sqlite or not os.path.isfile(sqlite)
+        ):
+            new_identifiers = None
+
+    appended = False
+    if new_identifiers is not None:
+        appended = append_to_master_csv(
+            fpaths_and_extra_data_for(new_identifiers),
+            output_csv_fpath,
+            state['header'],
+            workers,
+            sqlite,
+            new_identifiers
+        )
+        header_list = state['header']
+        if appended:
+            print("Appended {} new items".format(len(new_identifiers)))
+
+    if not appended:
+        header_list = build_master_csv(
+            fpaths_and_extra_data_for(identifiers),
+            output_csv_fpath,
+            workers,
+            sqlite,
+            identifiers
         )
-        for identifier in identifiers_where_overlay_is_true(dataset, "is_csv")
-    ]
 
-    import pprint; pprint.pprint(fpaths_and_extra_data)
+    # Full reductions record their state too, so that a later incremental
+    # reduction does not trust the state of the file they replaced.
+    size = os.path.getsize(output_csv_fpath)
+    save_state(state_file, dict(
+        dataset_uri=dataset.uri,
+        header=header_list,
+        items=item_hashes,
+        size=size,
+        tail=tail_checksum(output_csv_fpath, size),
+        sqlite=sqlite
+    ))
 
-    build_master_csv(fpaths_and_extra_data, 'all_cells.csv')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,173 @@
+"""Local on-disk cache of analysis output bundles.
+
+Entries are keyed on the input item identifier, the analysis version and the
+analysis parameters. The version includes a digest of the source of the
+analysis modules, so that any change to the code gives new keys, whether or
+not __version__ was bumped. As dtool identifiers are content hashes, an entry
+can be reused whenever the same item is analysed again with the same code and
+parameters. The cache is bounded in size, evicting the least recently used
+entries first.
+"""
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import tempfile
+
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+
+def version_from_script(fpath):
+    """Return the __version__ defined in a script, without importing it."""
+
+    with open(fpath) as fh:
+        match = re.search(
+            r'^__version__\s*=\s*[\'"]([^\'"]*)[\'"]',
+            fh.read(),
+            re.MULTILINE
+        )
+
+    if match is None:
+        raise ValueError("No __version__ in {}".format(fpath))
+
+    return match.group(1)
+
+
+def source_digest(fpaths):
+    """Return a digest of the contents of the source files."""
+
+    digest = hashlib.sha1()
+    for fpath in fpaths:
+        with open(fpath, 'rb') as fh:
+            digest.update(hashlib.sha1(fh.read()).digest())
+
+    return digest.hexdigest()
+
+
+def code_version(script_fpath, module_fpaths):
+    """Return the __version__ of the script together with a digest of the
+    source of the modules that affect its results."""
+
+    return '{}+{}'.format(
+        version_from_script(script_fpath),
+        source_digest(module_fpaths)[:12]
+    )
+
+
+def cache_key(identifier, version, parameters):
+    """Return the cache key for an item analysed with the given version and
+    parameters."""
+
+    key_data = json.dumps(
+        dict(identifier=identifier, version=version, parameters=parameters),
+        sort_keys=True
+    )
+
+    return hashlib.sha1(key_data.encode('utf-8')).hexdigest()
+
+
+def cache_from_environment():
+    """Return the cache configured by the SEEDCELLSIZE_CACHE_DIR and
+    SEEDCELLSIZE_CACHE_MAX_BYTES environment variables, or None if no cache
+    directory is set."""
+
+    directory = os.environ.get('SEEDCELLSIZE_CACHE_DIR')
+    if not directory:
+        return None
+
+    max_bytes = int(
+        os.environ.get('SEEDCELLSIZE_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)
+    )
+
+    return ResultCache(directory, max_bytes)
+
+
+def _directory_size(directory):
+    return sum(
+        os.path.getsize(os.path.join(directory, fname))
+        for fname in os.listdir(directory)
+    )
+
+
+class ResultCache(object):
+    """Size-bounded cache of output bundles with least recently used
+    eviction."""
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def fetch(self, key, output_directory):
+        """Copy the bundle for key into the output directory, returning True
+        on a hit and False on a miss."""
+
+        entry_path = self._entry_path(key)
+        if not os.path.isdir(entry_path):
+            return False
+
+        try:
+            for fname in os.listdir(entry_path):
+                shutil.copy(os.path.join(entry_path, fname), output_directory)
+            # Mark the entry as recently used.
+            os.utime(entry_path, None)
+        except (IOError, OSError):
+            # The entry was evicted while it was being read.
+            return False
+
+        return True
+
+    def store(self, key, output_directory):
+        """Store the files in the output directory as the bundle for key."""
+
+        entry_path = self._entry_path(key)
+        if os.path.isdir(entry_path):
+            return
+
+        # Copy into a temporary directory in the cache and rename it into
+        # place, so that a partially written entry is never visible.
+        staging_path = tempfile.mkdtemp(dir=self.directory, prefix='.tmp')
+        for fname in os.listdir(output_directory):
+            src_fpath = os.path.join(output_directory, fname)
+            if os.path.isfile(src_fpath):
+                shutil.copy(src_fpath, staging_path)
+
+        try:
+            os.rename(staging_path, entry_path)
+        except OSError:
+            # Another process stored the same entry first.
+            shutil.rmtree(staging_path, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in
+        max_bytes."""
+
+        entries = []
+        for key in os.listdir(self.directory):
+            if key.startswith('.'):
+                continue
+            entry_path = self._entry_path(key)
+            try:
+                entries.append((
+                    os.path.getmtime(entry_path),
+                    _directory_size(entry_path),
+                    entry_path
+                ))
+            except OSError:
+                continue
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total_bytes -= size
@@ -0,0 +1,162 @@
+"""Analyse a dataset, or one shard of it, without Redis.
+
+The items of the dataset are split deterministically into N shards by a hash
+of their identifiers, so that N machines given --shard 0/N to --shard N-1/N
+between them process every item exactly once, with no coordination. The
+items of the shard are analysed in a local pool of processes.
+
+Each item that is finished is appended to a checkpoint file. If the command
+is run again, for example after a crash, the items in the checkpoint file are
+skipped.
+"""
+
+import os
+import hashlib
+import traceback
+import multiprocessing
+
+import click
+
+from dtoolcore import DataSet
+
+import seedcellsize
+
+
+def parse_shard(ctx, param, value):
+    if value is None:
+        return 0, 1
+
+    try:
+        shard, num_shards = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise click.BadParameter("expected k/N, e.g. 0/4")
+
+    if not 0 <= shard < num_shards:
+        raise click.BadParameter("k must be from 0 to N-1")
+
+    return shard, num_shards
+
+
+def shard_of(identifier, num_shards):
+    """Return the shard of an identifier, which is the same on every machine
+    and in every run."""
+
+    digest = hashlib.sha1(identifier.encode('utf-8')).hexdigest()
+
+    return int(digest, 16) % num_shards
+
+
+def shard_identifiers(identifiers, shard, num_shards):
+    return sorted(
+        i for i in identifiers if shard_of(i, num_shards) == shard
+    )
+
+
+def load_checkpoint(fpath):
+    """Return the set of identifiers recorded as finished in the checkpoint
+    file."""
+
+    if not os.path.isfile(fpath):
+        return set()
+
+    with open(fpath) as fh:
+        return set(line.strip() for line in fh if line.strip())
+
+
+class Checkpoint(object):
+    """Append only record of the finished items of a shard."""
+
+    def __init__(self, fpath):
+        self.fh = open(fpath, 'a')
+
+    def add(self, identifier):
+        self.fh.write(identifier + '\n')
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def close(self):
+        self.fh.close()
+
+
+def analyse_item(args):
+    """Analyse one item in a pool process, returning its identifier and
+    whether it succeeded."""
+
+    dataset_uri, identifier, output_dataset_uri = args
+
+    try:
+        seedcellsize.run_task(dataset_uri, identifier, output_dataset_uri)
+    except Exception:
+        traceback.print_exc()
+        return identifier, False
+
+    return identifier, True
+
+
+@click.command()
+@click.argument('dataset-uri')
+@click.argument('output-dataset-uri')
+@click.option('--shard', callback=parse_shard, default=None,
+              help='Only analyse shard k of N, numbered from 0, e.g. 0/4 '
+                   '(default: the whole dataset)')
+@click.option('--jobs', type=int, default=multiprocessing.cpu_count(),
+              help='Number of items to analyse at once '
+                   '(default: number of CPUs)')
+@click.option('--checkpoint', 'checkpoint_fpath', default=None,
+              help='File recording the finished items '
+                   '(default: shard-<k>-of-<N>.checkpoint)')
+def main(dataset_uri, output_dataset_uri, shard, jobs, checkpoint_fpath):
+    shard, num_shards = shard
+
+    if checkpoint_fpath is None:
+        checkpoint_fpath = 'shard-{}-of-{}.checkpoint'.format(
+            shard,
+            num_shards
+        )
+
+    dataset = DataSet.from_uri(dataset_uri)
+    identifiers = shard_identifiers(dataset.identifiers, shard, num_shards)
+
+    finished = load_checkpoint(checkpoint_fpath)
+    todo = [i for i in identifiers if i not in finished]
+
+    print("Shard {}/{}: {} items, {} already finished".format(
+        shard,
+        num_shards,
+        len(identifiers),
+        len(identifiers) - len(todo)
+        )
+    )
+
+    checkpoint = Checkpoint(checkpoint_fpath)
+    pool = multiprocessing.Pool(jobs)
+
+    failed = []
+    try:
+        results = pool.imap_unordered(
+            analyse_item,
+            [(dataset_uri, i, output_dataset_uri) for i in todo]
+        )
+        for n, (identifier, succeeded) in enumerate(results, 1):
+            if succeeded:
+                checkpoint.add(identifier)
+            else:
+                print("Failed on {}".format(identifier))
+                failed.append(identifier)
+            print("Processed {} of {}".format(n, len(todo)))
+    finally:
+        pool.terminate()
+        pool.join()
+        checkpoint.close()
+
+    if failed:
+        raise click.ClickException(
+            "Failed on {} of {} items; run again to retry them".format(
+                len(failed),
+                len(todo)
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
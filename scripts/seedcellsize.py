@@ -1,17 +1,98 @@
 """Wrapper script for seed cell size analysis."""
 
 import os
+import sys
+import shutil
 import argparse
+import tempfile
 import subprocess
 
 from dtoolcore import DataSet, ProtoDataSet
 
-from dtoolutils import temp_working_dir, stage_outputs
+from dtoolutils import (
+    PENDING_UPLOADS,
+    PREFETCH,
+    TMPDIR_PREFIX,
+    run_pipeline,
+    stage_outputs
+)
+from resultcache import (
+    ResultCache,
+    cache_key,
+    cache_from_environment,
+    code_version
+)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ANALYSIS_SCRIPT = os.path.join(HERE, 'analysis.py')
+
+# Modules whose code affects the outputs, and so the cache keys.
+ANALYSIS_MODULES = [
+    os.path.join(HERE, name)
+    for name in [
+        'analysis.py',
+        'cellparameters.py',
+        'localthreshold.py',
+        'tiledsegment.py'
+    ]
+]
+
+_analysis_version = None
+
+
+def analysis_version():
+    """Return the version of the analysis code, read once per process."""
+    global _analysis_version
+
+    if _analysis_version is None:
+        _analysis_version = code_version(ANALYSIS_SCRIPT, ANALYSIS_MODULES)
+
+    return _analysis_version
+
+OUTPUTS = [
+    'original.png',
+    'segmentation.png',
+    'labels.png',
+    'false_color.png',
+    'results.csv',
+    'results.npz'
+]
 
 
 class PythonSmartTool(object):
 
-    def __init__(self):
+    def __init__(self, input_dataset, output_dataset, identifier):
+        self.input_dataset = input_dataset
+        self.output_dataset = output_dataset
+        self.identifier = identifier
+        self.in_process = False
+        self.parameters = {}
+        self.cache = None
+        self.outputs = OUTPUTS
+
+    def select_outputs(self, outputs):
+        """Only produce and stage the outputs listed.
+
+        Images that are not wanted are not rendered by the analysis at all.
+        """
+
+        unknown = set(outputs) - set(OUTPUTS)
+        if unknown:
+            raise ValueError("Unknown outputs: {}".format(
+                ", ".join(sorted(unknown)))
+            )
+
+        self.outputs = [o for o in OUTPUTS if o in outputs]
+        if self.outputs == OUTPUTS:
+            self.parameters.pop('outputs', None)
+        else:
+            self.parameters['outputs'] = self.outputs
+
+    @classmethod
+    def from_args(cls, args=None):
+        """Return a tool for each item given on the command line, and the
+        parsed arguments."""
+
         parser = argparse.ArgumentParser()
 
         parser.add_argument(
@@ -22,60 +103,306 @@ class PythonSmartTool(object):
         parser.add_argument(
             '-i',
             '--identifier',
-            help='Identifier (hash) to process'
+            action='append',
+            dest='identifiers',
+            help='Identifier (hash) to process; give more than once to '
+                 'process several items in one batch'
         )
         parser.add_argument(
             '-o',
             '--output-dataset',
             help='URI of output dataset'
         )
+        parser.add_argument(
+            '--cache-dir',
+            help='Directory of local result cache (default: from the '
+                 'SEEDCELLSIZE_CACHE_DIR environment variable, if set)'
+        )
+        parser.add_argument(
+            '--outputs',
+            default=os.environ.get('SEEDCELLSIZE_OUTPUTS'),
+            help='Comma separated outputs to produce (default: from the '
+                 'SEEDCELLSIZE_OUTPUTS environment variable, if set, '
+                 'otherwise all of {})'.format(','.join(OUTPUTS))
+        )
+        parser.add_argument(
+            '--png-compression',
+            type=int,
+            help='PNG compression level, from 0 (fastest) to 9'
+        )
+        parser.add_argument(
+            '--prefetch',
+            type=int,
+            default=os.environ.get('SEEDCELLSIZE_PREFETCH', PREFETCH),
+            help='Number of items of a batch to fetch ahead of the analysis '
+                 '(default: from the SEEDCELLSIZE_PREFETCH environment '
+                 'variable, if set, otherwise {})'.format(PREFETCH)
+        )
+        parser.add_argument(
+            '--pending-uploads',
+            type=int,
+            default=os.environ.get(
+                'SEEDCELLSIZE_PENDING_UPLOADS',
+                PENDING_UPLOADS
+            ),
+            help='Number of analysed items of a batch that may wait to be '
+                 'staged (default: from the SEEDCELLSIZE_PENDING_UPLOADS '
+                 'environment variable, if set, otherwise {})'.format(
+                     PENDING_UPLOADS
+                 )
+        )
 
-        args = parser.parse_args()
+        args = parser.parse_args(args)
 
-        self.input_dataset = DataSet.from_uri(args.dataset)
-        self.output_dataset = ProtoDataSet.from_uri(args.output_dataset)
+        input_dataset = DataSet.from_uri(args.dataset)
+        output_dataset = ProtoDataSet.from_uri(args.output_dataset)
+        if args.cache_dir:
+            cache = ResultCache(args.cache_dir)
+        else:
+            cache = cache_from_environment()
 
-        self.identifier = args.identifier
+        tools = []
+        for identifier in args.identifiers or []:
+            tool = cls(input_dataset, output_dataset, identifier)
+            tool.cache = cache
 
-    def run(self):
+            if args.outputs:
+                tool.select_outputs(args.outputs.split(','))
+            if args.png_compression is not None:
+                tool.parameters['png_compression'] = args.png_compression
+            if os.environ.get('SEEDCELLSIZE_PROFILE'):
+                tool.parameters['profile'] = True
+
+            tools.append(tool)
+
+        return tools, args
 
-        input_path = self.input_dataset.item_content_abspath(self.identifier)
+    def analyse(self, input_path, output_directory):
+        """Analyse the input file, writing results to the output directory.
 
-        with temp_working_dir() as tmpdir:
-            command = ["python", "/scripts/analysis.py"]
+        By default the analysis runs in a fresh interpreter. If in_process is
+        set it runs in the current process, which avoids paying the start up
+        and import costs again in long-lived workers.
+        """
+
+        if not self.in_process:
+            command = ["python", ANALYSIS_SCRIPT]
             command += ["-i", input_path]
-            command += ["-o", tmpdir]
+            command += ["-o", output_directory]
+            for name, value in sorted(self.parameters.items()):
+                option = "--" + name.replace("_", "-")
+                if value is None or value is False:
+                    continue
+                if value is True:
+                    command += [option]
+                    continue
+                if isinstance(value, (list, tuple)):
+                    value = ",".join(value)
+                command += [option, str(value)]
+
+            subprocess.check_call(command)
+            return
 
-            subprocess.call(command)
+        import analysis
 
-            outputs_with_metadata = [(o, {}) for o in self.outputs]
+        analysis.configure_output(output_directory)
+        with analysis.audit_log(output_directory):
+            analysis.analyse_file(input_path, output_directory,
+                                  **self.parameters)
 
-            stage_outputs(
-                outputs_with_metadata,
-                tmpdir,
-                self.input_dataset,
-                self.output_dataset,
-                [],
+    def cache_key(self):
+        if self.cache is None:
+            return None
+
+        return cache_key(
+            self.identifier,
+            analysis_version(),
+            self.parameters
+        )
+
+    def fetch(self):
+        """Return a new working directory and the local path of the input,
+        which is fetched if need be.
+
+        If the results are cached they are copied into the working directory
+        instead, and the input path is None.
+        """
+
+        tmpdir = tempfile.mkdtemp(prefix=TMPDIR_PREFIX)
+
+        try:
+            key = self.cache_key()
+            if key is not None and self.cache.fetch(key, tmpdir):
+                print("Using cached results for {}".format(self.identifier))
+                return tmpdir, None
+
+            input_path = self.input_dataset.item_content_abspath(
                 self.identifier
             )
+        except Exception:
+            shutil.rmtree(tmpdir)
+            raise
+
+        return tmpdir, input_path
+
+    def compute(self, tmpdir, input_path):
+        """Analyse the input, unless the results were cached."""
+
+        if input_path is None:
+            return
+
+        self.analyse(input_path, tmpdir)
+
+        key = self.cache_key()
+        if key is not None:
+            self.cache.store(key, tmpdir)
+
+    def stage(self, tmpdir):
+
+        outputs = list(self.outputs)
+        if self.parameters.get('profile'):
+            outputs.append('profile.json')
+        outputs_with_metadata = [(o, {}) for o in outputs]
+
+        stage_outputs(
+            outputs_with_metadata,
+            tmpdir,
+            self.input_dataset,
+            self.output_dataset,
+            [],
+            self.identifier
+        )
+
+    def run(self):
+
+        tmpdir, input_path = self.fetch()
+        try:
+            self.compute(tmpdir, input_path)
+            self.stage(tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+def run_batch(tools, prefetch=PREFETCH, pending_uploads=PENDING_UPLOADS):
+    """Run the tools, fetching the inputs of the next prefetch items and
+    staging the outputs of up to pending_uploads earlier ones in the
+    background while each one is analysed.
+
+    :returns: list of (tool, exception) tuples for the tools that failed
+    """
+
+    def fetch(tool):
+        return tool.fetch()
+
+    def compute(tool, fetched):
+        tmpdir, input_path = fetched
+        try:
+            tool.compute(tmpdir, input_path)
+        except Exception:
+            shutil.rmtree(tmpdir)
+            raise
+        return tmpdir
+
+    def upload(tool, tmpdir):
+        try:
+            tool.stage(tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    return run_pipeline(
+        tools,
+        fetch,
+        compute,
+        upload,
+        prefetch=prefetch,
+        pending_uploads=pending_uploads
+    )
+
+
+_datasets = {}
+
+
+def tool_for_task(dataset_uri, identifier, output_dataset_uri):
+    """Return a tool to analyse the item in the current process.
+
+    Datasets are loaded once per process and reused for subsequent tasks.
+    """
+
+    key = (dataset_uri, output_dataset_uri)
+    if key not in _datasets:
+        _datasets[key] = (
+            DataSet.from_uri(dataset_uri),
+            ProtoDataSet.from_uri(output_dataset_uri)
+        )
+    input_dataset, output_dataset = _datasets[key]
+
+    tool = PythonSmartTool(input_dataset, output_dataset, identifier)
+    tool.in_process = True
+    tool.cache = cache_from_environment()
+
+    if os.environ.get('SEEDCELLSIZE_OUTPUTS'):
+        tool.select_outputs(os.environ['SEEDCELLSIZE_OUTPUTS'].split(','))
+    if os.environ.get('SEEDCELLSIZE_PROFILE'):
+        tool.parameters['profile'] = True
+
+    return tool
+
+
+def run_task(dataset_uri, identifier, output_dataset_uri):
+    """Analyse one item in the current process.
+
+    This is the entry point used by warm worker processes.
+    """
+
+    tool_for_task(dataset_uri, identifier, output_dataset_uri).run()
+
+
+def run_tasks(dataset_uri, identifiers, output_dataset_uri):
+    """Analyse several items in the current process, overlapping fetching
+    and staging with the analysis."""
+
+    tools = [
+        tool_for_task(dataset_uri, identifier, output_dataset_uri)
+        for identifier in identifiers
+    ]
+
+    failures = run_batch(
+        tools,
+        prefetch=int(os.environ.get('SEEDCELLSIZE_PREFETCH', PREFETCH)),
+        pending_uploads=int(
+            os.environ.get('SEEDCELLSIZE_PENDING_UPLOADS', PENDING_UPLOADS)
+        )
+    )
+    if failures:
+        raise RuntimeError("Failed on {} of {} items: {}".format(
+            len(failures),
+            len(tools),
+            ", ".join(tool.identifier for tool, _ in failures)
+            )
+        )
 
 
 def main():
 
-    tool = PythonSmartTool()
+    tools, args = PythonSmartTool.from_args()
 
     # tool.run()
     # tool.container = "jicscicomp/seedcellsize"
     # tool.command_string = "python /scripts/analysis.py -i /input1 -o /output"
-    tool.outputs = [
-        'original.png',
-        'segmentation.png',
-        'labels.png',
-        'false_color.png',
-        'results.csv'
-    ]
 
-    tool.run()
+    if len(tools) == 1:
+        tools[0].run()
+        return
+
+    failures = run_batch(
+        tools,
+        prefetch=args.prefetch,
+        pending_uploads=args.pending_uploads
+    )
+    for tool, exception in failures:
+        print("Failed on {}: {}".format(tool.identifier, exception))
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
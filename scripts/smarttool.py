@@ -1,29 +1,37 @@
 """Smart tool."""
 
 import os
+import json
 import shlex
+import atexit
 import shutil
 import argparse
 import tempfile
+import threading
 import subprocess
 
-from contextlib import contextmanager
-
 from dtool_azure import AzureDataSet, AzureProtoDataSet
 
+from dtoolutils import (
+    PENDING_UPLOADS,
+    PREFETCH,
+    cached_overlay,
+    map_in_threads,
+    run_pipeline,
+    with_retries
+)
+
 TMPDIR_PREFIX = os.path.expanduser(
     "~/tmp/tmp"
 )
 
+# Shared with the containers of persistent job servers.
+SCRATCH_DIR = os.path.expanduser(
+    "~/tmp/scratch"
+)
+CONTAINER_SCRATCH_DIR = "/scratch"
 
-@contextmanager
-def temp_working_dir():
-    working_dir = tempfile.mkdtemp(prefix=TMPDIR_PREFIX)
-
-    try:
-        yield working_dir
-    finally:
-        shutil.rmtree(working_dir)
+JOB_SERVER_SCRIPT = "/scripts/jobserver.py"
 
 
 class DockerAssist(object):
@@ -32,13 +40,18 @@ class DockerAssist(object):
         self.image_name = image_name
         self.base_command = base_command
         self.volume_mounts = []
+        self.process = None
+        self._lock = threading.Lock()
 
     def add_volume_mount(self, outside, inside):
         self.volume_mounts.append((outside, inside))
 
     @property
     def command(self):
-        command_string = ['docker', 'run', '--rm']
+        return self._docker_command()
+
+    def _docker_command(self, options=()):
+        command_string = ['docker', 'run', '--rm'] + list(options)
 
         for outside, inside in self.volume_mounts:
             command_string += ['-v', '{}:{}'.format(outside, inside)]
@@ -59,10 +72,103 @@ class DockerAssist(object):
     def run_and_capture_stdout(self):
         return subprocess.check_output(self.command)
 
+    def start(self):
+        """Start a long-lived container running base_command as a job server
+        (see jobserver.py), which reads jobs from its stdin."""
+
+        self.process = subprocess.Popen(
+            self._docker_command(['-i']),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            universal_newlines=True
+        )
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def submit(self, job_id, args):
+        """Run a job in the job server, returning its status."""
+
+        with self._lock:
+            job = dict(id=job_id, args=args)
+            self.process.stdin.write(json.dumps(job) + '\n')
+            self.process.stdin.flush()
+
+            line = self.process.stdout.readline()
+
+        if not line:
+            raise RuntimeError("Job server in {} exited with status {}".format(
+                self.image_name,
+                self.process.wait()
+                )
+            )
+
+        return json.loads(line)
+
+    def stop(self):
+        if self.process is None:
+            return
+
+        self.process.stdin.close()
+        self.process.wait()
+        self.process = None
+
+
+_job_servers = {}
+_job_servers_lock = threading.Lock()
+
+
+def job_server(image_name, tool_path):
+    """Return a running job server for the tool in a container of the image,
+    starting one the first time it is needed in this process.
+
+    The scratch directory is mounted in the container once, and the inputs
+    and outputs of each job are passed through it.
+    """
+
+    key = (image_name, tool_path)
+
+    with _job_servers_lock:
+        server = _job_servers.get(key)
+        if server is None or not server.running:
+            if not os.path.isdir(SCRATCH_DIR):
+                os.makedirs(SCRATCH_DIR)
+            server = DockerAssist(
+                image_name,
+                "python {} {}".format(JOB_SERVER_SCRIPT, tool_path)
+            )
+            server.add_volume_mount(SCRATCH_DIR, CONTAINER_SCRATCH_DIR)
+            server.start()
+            _job_servers[key] = server
+
+    return server
+
+
+@atexit.register
+def _stop_job_servers():
+    for server in _job_servers.values():
+        server.stop()
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
 
 class SmartTool(object):
 
-    def __init__(self):
+    # Run items through a job server in one long-lived container per process,
+    # rather than starting a container for each item.
+    persistent = False
+
+    # Depth of the fetch and upload stages of run_batch.
+    prefetch = PREFETCH
+    pending_uploads = PENDING_UPLOADS
+
+    def __init__(self, args=None):
         parser = argparse.ArgumentParser()
 
         parser.add_argument(
@@ -85,8 +191,42 @@ class SmartTool(object):
             help='Path to Azure config for input dataset',
             default=None
         )
+        parser.add_argument(
+            '--persistent',
+            action='store_true',
+            default=bool(os.environ.get('SMARTTOOL_PERSISTENT')),
+            help='Run items through a long-lived job server container '
+                 '(default: from the SMARTTOOL_PERSISTENT environment '
+                 'variable, if set)'
+        )
+        parser.add_argument(
+            '--prefetch',
+            type=int,
+            default=os.environ.get('SMARTTOOL_PREFETCH', PREFETCH),
+            help='Number of items of a batch to fetch ahead of the analysis '
+                 '(default: from the SMARTTOOL_PREFETCH environment '
+                 'variable, if set, otherwise {})'.format(PREFETCH)
+        )
+        parser.add_argument(
+            '--pending-uploads',
+            type=int,
+            default=os.environ.get(
+                'SMARTTOOL_PENDING_UPLOADS',
+                PENDING_UPLOADS
+            ),
+            help='Number of analysed items of a batch that may wait to be '
+                 'staged (default: from the SMARTTOOL_PENDING_UPLOADS '
+                 'environment variable, if set, otherwise {})'.format(
+                     PENDING_UPLOADS
+                 )
+        )
+
+        args = parser.parse_args(args)
 
-        args = parser.parse_args()
+        if args.persistent:
+            self.persistent = True
+        self.prefetch = args.prefetch
+        self.pending_uploads = args.pending_uploads
 
         self.input_dataset = AzureDataSet.from_uri(
             args.dataset,
@@ -97,32 +237,182 @@ class SmartTool(object):
 
         self.identifier = args.identifier
 
-    def stage_outputs(self, working_directory):
-        for filename in self.outputs:
+    def stage_outputs(self, working_directory, identifier=None):
+        if identifier is None:
+            identifier = self.identifier
 
-            useful_name = self.input_dataset.access_overlay(
-                'useful_name'
-            )[self.identifier]
+        useful_name = cached_overlay(
+            self.input_dataset,
+            'useful_name'
+        )[identifier]
 
+        def stage(filename):
             fpath = os.path.join(working_directory, filename)
             relpath = os.path.join(useful_name, filename)
-            out_id = self.output_dataset.put_item(fpath, relpath)
-            self.output_dataset.add_item_metadata(
+            out_id = with_retries(self.output_dataset.put_item, fpath, relpath)
+            with_retries(
+                self.output_dataset.add_item_metadata,
                 out_id,
                 'from',
-                "{}/{}".format(self.input_dataset.uuid, self.identifier)
+                "{}/{}".format(self.input_dataset.uuid, identifier)
+                )
+
+        map_in_threads(stage, self.outputs)
+
+    def new_working_directory(self):
+        if self.persistent:
+            # The job server can only see the scratch directory.
+            if not os.path.isdir(SCRATCH_DIR):
+                os.makedirs(SCRATCH_DIR)
+            return tempfile.mkdtemp(dir=SCRATCH_DIR)
+
+        return tempfile.mkdtemp(prefix=TMPDIR_PREFIX)
+
+    def analyse(self, identifier, input_file_path, working_directory):
+        """Run the tool on the input, writing its outputs to the working
+        directory."""
+
+        if self.persistent:
+            self.analyse_in_job_server(
+                identifier,
+                input_file_path,
+                working_directory
+            )
+            return
+
+        runner = DockerAssist(self.container, self.command_string)
+        runner.add_volume_mount(input_file_path, '/input1')
+        runner.add_volume_mount(working_directory, '/output')
+
+        runner.run()
+
+    def analyse_in_job_server(self, identifier, input_file_path,
+                              working_directory):
+        """Run the tool on the input in this process's job server.
+
+        The input is linked into the working directory, which is in the
+        scratch directory, and the /input1 and /output arguments of the
+        command string are pointed at the container's view of them.
+        """
+
+        command = shlex.split(self.command_string)
+        tool_path, tool_args = command[1], command[2:]
+
+        server = job_server(self.container, tool_path)
+
+        job_input_path = os.path.join(working_directory, 'input1')
+        link_or_copy(input_file_path, job_input_path)
+
+        container_working_directory = '/'.join([
+            CONTAINER_SCRATCH_DIR,
+            os.path.basename(working_directory)
+        ])
+        container_paths = {
+            '/input1': container_working_directory + '/input1',
+            '/output': container_working_directory
+        }
+        args = [container_paths.get(a, a) for a in tool_args]
+
+        try:
+            status = server.submit(identifier, args)
+        finally:
+            os.unlink(job_input_path)
+
+        print("{} {} in {:.1f}s".format(
+            identifier,
+            status['status'],
+            status['wall_time']
+            )
+        )
+        if status['status'] != 'ok':
+            raise RuntimeError("Failed on {}: {}".format(
+                identifier,
+                status.get('error')
                 )
+            )
 
     def run(self):
         input_file_path = self.input_dataset.item_contents_abspath(
             self.identifier
         )
 
-        with temp_working_dir() as working_directory:
-            runner = DockerAssist(self.container, self.command_string)
-            runner.add_volume_mount(input_file_path, '/input1')
-            runner.add_volume_mount(working_directory, '/output')
+        working_directory = self.new_working_directory()
+        try:
+            self.analyse(self.identifier, input_file_path, working_directory)
+            self.stage_outputs(working_directory)
+        finally:
+            shutil.rmtree(working_directory)
+
+    def run_batch(self, identifiers):
+        """Run the tool on each of the items, fetching the inputs of the next
+        prefetch items and staging the outputs of up to pending_uploads
+        earlier ones in the background while each one is analysed.
+
+        :returns: list of (identifier, exception) tuples for the items that
+                  failed
+        """
+
+        def compute(identifier, input_file_path):
+            working_directory = self.new_working_directory()
+            try:
+                self.analyse(identifier, input_file_path, working_directory)
+            except Exception:
+                shutil.rmtree(working_directory)
+                raise
+            return working_directory
+
+        def upload(identifier, working_directory):
+            try:
+                self.stage_outputs(working_directory, identifier)
+            finally:
+                shutil.rmtree(working_directory)
+
+        return run_pipeline(
+            identifiers,
+            self.input_dataset.item_contents_abspath,
+            compute,
+            upload,
+            prefetch=self.prefetch,
+            pending_uploads=self.pending_uploads
+        )
 
-            runner.run()
 
-            self.stage_outputs(working_directory)
+def task_functions(tool_class):
+    """Return run_task and run_tasks functions for the module of a tool, for
+    worker.py to run its tasks in warm worker processes.
+
+    The tool is created once per process for each pair of datasets and runs
+    in persistent mode, so that each worker process sends all of its items
+    to one long-lived job server container. For example::
+
+        run_task, run_tasks = task_functions(MyTool)
+    """
+
+    tools = {}
+
+    def tool_for(dataset_uri, output_dataset_uri):
+        key = (dataset_uri, output_dataset_uri)
+        if key not in tools:
+            tools[key] = tool_class([
+                '-d', dataset_uri,
+                '-o', output_dataset_uri,
+                '--persistent'
+            ])
+        return tools[key]
+
+    def run_task(dataset_uri, identifier, output_dataset_uri):
+        run_tasks(dataset_uri, [identifier], output_dataset_uri)
+
+    def run_tasks(dataset_uri, identifiers, output_dataset_uri):
+        failures = tool_for(dataset_uri, output_dataset_uri).run_batch(
+            identifiers
+        )
+        if failures:
+            raise RuntimeError("Failed on {} of {} items: {}".format(
+                len(failures),
+                len(identifiers),
+                ", ".join(identifier for identifier, _ in failures)
+                )
+            )
+
+    return run_task, run_tasks
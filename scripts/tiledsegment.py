@@ -0,0 +1,234 @@
+"""Tiled, memory-bounded segmentation of large images.
+
+The image is split into tiles that are segmented in parallel. Each tile is
+processed together with a halo of surrounding pixels, so that the local
+thresholding and small object removal give the same result in the tile as
+they would on the whole image. The tiles are labelled independently and the
+labels are stitched together across tile boundaries, giving the same
+segmentation as the whole image path with peak working memory bounded by the
+tile size.
+"""
+
+import numpy as np
+
+import scipy.sparse
+import scipy.sparse.csgraph
+
+import skimage.measure
+import skimage.morphology
+
+import dask
+from dask import delayed
+
+from localthreshold import local_threshold
+
+SMALL_OBJECT_SIZE = 50
+
+
+def default_halo(block_size, min_size=SMALL_OBJECT_SIZE):
+    """Return a halo wide enough for the thresholding and both small object
+    removal steps to be exact in the tile."""
+
+    return block_size + 2 * min_size
+
+
+def tile_slices(shape, tile_size):
+    """Return the (row, col) slices of the tiles covering an image."""
+
+    nrows, ncols = shape
+
+    return [
+        (
+            slice(r, min(r + tile_size, nrows)),
+            slice(c, min(c + tile_size, ncols))
+        )
+        for r in range(0, nrows, tile_size)
+        for c in range(0, ncols, tile_size)
+    ]
+
+
+def segment_mask(image, block_size, threshold_method='gaussian',
+                 min_size=SMALL_OBJECT_SIZE):
+    """Return the binary mask of the cells, as computed by
+    preprocess_and_segment in analysis.py."""
+
+    mask = local_threshold(image, block_size, threshold_method)
+    mask = skimage.morphology.remove_small_objects(
+        mask,
+        min_size=min_size,
+        connectivity=1
+    )
+    mask = ~skimage.morphology.remove_small_objects(
+        ~mask,
+        min_size=min_size,
+        connectivity=1
+    )
+
+    return mask
+
+
+def _label_tile(image, labels, tile, halo, block_size, threshold_method,
+                min_size):
+    """Label the cells in a tile, writing the labels into the labels array.
+
+    :returns: number of labels and the flat index in the whole image of the
+              first pixel of each label
+    """
+
+    _, ncols = image.shape
+    extended = tuple(
+        slice(max(s.start - halo, 0), min(s.stop + halo, n))
+        for s, n in zip(tile, image.shape)
+    )
+    inner = tuple(
+        slice(s.start - e.start, s.stop - e.start)
+        for s, e in zip(tile, extended)
+    )
+
+    mask = segment_mask(
+        np.asarray(image[extended]),
+        block_size,
+        threshold_method,
+        min_size
+    )
+
+    tile_labels, num = skimage.measure.label(
+        mask[inner],
+        connectivity=2,
+        background=0,
+        return_num=True
+    )
+    labels[tile] = tile_labels
+
+    values, first = np.unique(tile_labels.ravel(), return_index=True)
+    first = first[values > 0]
+
+    tile_ncols = tile_labels.shape[1]
+    rows = first // tile_ncols + tile[0].start
+    cols = first % tile_ncols + tile[1].start
+
+    return num, rows * ncols + cols
+
+
+def _boundary_pairs(a, b):
+    """Return the pairs of labels that touch, with 8-connectivity, across the
+    boundary between the adjacent lines of pixels a and b."""
+
+    pairs = [(a, b), (a[:-1], b[1:]), (a[1:], b[:-1])]
+
+    src = np.concatenate([x[(x > 0) & (y > 0)] for x, y in pairs])
+    dst = np.concatenate([y[(x > 0) & (y > 0)] for x, y in pairs])
+
+    return src, dst
+
+
+def segment_tiled(
+    image,
+    tile_size=2048,
+    halo=None,
+    block_size=91,
+    threshold_method='gaussian',
+    min_size=SMALL_OBJECT_SIZE,
+    num_workers=None
+):
+    """Return the labelled cells in the image with the cells touching the
+    image border cleared, segmenting the image tile by tile.
+
+    :param image: 2D grayscale image
+    :param tile_size: width and height of the tiles
+    :param halo: pixels of context around each tile, at least block_size
+                 (default: block_size + 2 * min_size)
+    :param block_size: block size of the adaptive threshold
+    :param threshold_method: local threshold method, see localthreshold.py
+    :param min_size: size of the small objects and holes to remove
+    :param num_workers: number of tiles to segment in parallel
+                        (default: number of CPUs)
+    """
+
+    if halo is None:
+        halo = default_halo(block_size, min_size)
+    if halo < block_size:
+        raise ValueError(
+            "Halo ({}) must be at least the block size ({})".format(
+                halo,
+                block_size
+            )
+        )
+
+    tiles = tile_slices(image.shape, tile_size)
+    labels = np.zeros(image.shape, dtype=np.int32)
+
+    # The tiles write their labels into disjoint parts of the labels array,
+    # so they are run with the threaded scheduler.
+    tasks = [
+        delayed(_label_tile)(
+            image,
+            labels,
+            tile,
+            halo,
+            block_size,
+            threshold_method,
+            min_size
+        )
+        for tile in tiles
+    ]
+    results = dask.compute(*tasks, num_workers=num_workers)
+
+    # Make the labels unique across tiles.
+    offset = 0
+    first_pixels = [np.array([-1])]
+    for tile, (num, first) in zip(tiles, results):
+        tile_labels = labels[tile]
+        tile_labels[tile_labels > 0] += offset
+        first_pixels.append(first)
+        offset += num
+    first_pixels = np.concatenate(first_pixels)
+
+    # Join labels that touch across tile boundaries.
+    src, dst = [np.array([], dtype=np.int32)], [np.array([], dtype=np.int32)]
+    for r in range(tile_size, image.shape[0], tile_size):
+        s, d = _boundary_pairs(labels[r - 1, :], labels[r, :])
+        src.append(s)
+        dst.append(d)
+    for c in range(tile_size, image.shape[1], tile_size):
+        s, d = _boundary_pairs(labels[:, c - 1], labels[:, c])
+        src.append(s)
+        dst.append(d)
+    src = np.concatenate(src)
+    dst = np.concatenate(dst)
+
+    graph = scipy.sparse.coo_matrix(
+        (np.ones(len(src), dtype=np.int8), (src, dst)),
+        shape=(offset + 1, offset + 1)
+    )
+    num_components, components = scipy.sparse.csgraph.connected_components(
+        graph,
+        directed=False
+    )
+
+    # Number the cells in the order of their first pixel in a raster scan,
+    # as whole image labelling does. The background sorts first, keeping
+    # the label 0.
+    component_first = np.empty(num_components, dtype=np.int64)
+    component_first.fill(np.iinfo(np.int64).max)
+    np.minimum.at(component_first, components, first_pixels)
+
+    rank = np.empty(num_components, dtype=np.int32)
+    rank[np.argsort(component_first)] = np.arange(num_components)
+    lookup = rank[components]
+
+    # Clear the cells touching the image border.
+    border_labels = np.concatenate([
+        lookup[labels[0, :]],
+        lookup[labels[-1, :]],
+        lookup[labels[:, 0]],
+        lookup[labels[:, -1]],
+    ])
+    is_border = np.zeros(num_components, dtype=bool)
+    is_border[border_labels] = True
+    lookup[is_border[lookup]] = 0
+
+    for tile in tiles:
+        labels[tile] = lookup[labels[tile]]
+
+    return labels
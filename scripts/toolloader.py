@@ -0,0 +1,25 @@
+"""Import tool scripts by path."""
+
+import os
+import imp
+import sys
+
+_tools = {}
+
+
+def load_tool(tool_path):
+    """Return the tool module at tool_path, importing it once per process.
+
+    The directory of the tool is added to the module search path, so that
+    the tool can import the modules alongside it.
+    """
+
+    if tool_path not in _tools:
+        tool_dir = os.path.dirname(os.path.abspath(tool_path))
+        if tool_dir not in sys.path:
+            sys.path.insert(0, tool_dir)
+
+        name, _ = os.path.splitext(os.path.basename(tool_path))
+        _tools[tool_path] = imp.load_source(name, tool_path)
+
+    return _tools[tool_path]
@@ -1,40 +1,409 @@
+import os
 import json
 import time
 import shlex
+import socket
+import threading
+import traceback
 import subprocess
+import multiprocessing
 
 import click
 import redis
 
+from toolloader import load_tool
+
+
+def task_identifiers(task):
+    """Return the item identifiers to process for the task.
+
+    Tasks either name a single item identifier or, when several items are
+    grouped into one task, list them under "identifiers".
+    """
+    return task.get("identifiers", [task["identifier"]])
+
 
 def execute_task(task):
 
-    command = ['python'] + shlex.split(task["tool_path"])
-    command += ['-d', task["input_uuid"]]
-    command += ['-i', task["identifier"]]
-    command += ['-o', task["output_uuid"]]
+    for identifier in task_identifiers(task):
+        command = ['python'] + shlex.split(task["tool_path"])
+        command += ['-d', task["input_uuid"]]
+        command += ['-i', identifier]
+        command += ['-o', task["output_uuid"]]
 
-    return subprocess.call(command)
+        return_code = subprocess.call(command)
+        if return_code != 0:
+            return return_code
 
+    return 0
 
-@click.command()
-@click.option('--redis-host', envvar='REDIS_HOST')
-def main(redis_host):
-    r = redis.StrictRedis(host=redis_host, port=6379)
+
+def execute_task_in_process(task):
+    """Run the task in the current process using the run_task function of the
+    tool module, returning True if the task succeeded.
+
+    Tasks with several items are passed to the tool's run_tasks function
+    instead, if it has one, so that it can fetch and stage items in the
+    background while it analyses others.
+    """
+
+    tool_path = shlex.split(task["tool_path"])[0]
+    identifiers = task_identifiers(task)
+
+    try:
+        tool = load_tool(tool_path)
+        if len(identifiers) > 1 and hasattr(tool, 'run_tasks'):
+            tool.run_tasks(
+                task["input_uuid"],
+                identifiers,
+                task["output_uuid"]
+            )
+        else:
+            for identifier in identifiers:
+                tool.run_task(
+                    task["input_uuid"],
+                    identifier,
+                    task["output_uuid"]
+                )
+    except Exception:
+        traceback.print_exc()
+        return False
+
+    return True
+
+
+# Move the task with the highest priority from the work queue to the in
+# progress list in one step, so that it cannot be lost in between.
+TAKE_TASK_SCRIPT = """
+local task_identifiers = redis.call('ZREVRANGE', KEYS[1], 0, 0)
+if #task_identifiers == 0 then
+    return false
+end
+redis.call('ZREM', KEYS[1], task_identifiers[1])
+redis.call('LPUSH', KEYS[2], task_identifiers[1])
+return task_identifiers[1]
+"""
+
+# Move a task from the in progress list back to the work queue, or to the
+# dead letter list once it has been retried too often, in one step, so that
+# it cannot be lost in between. Returns the number of retries, or nothing if
+# the task was not in progress.
+REQUEUE_SCRIPT = """
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 0 then
+    return false
+end
+local retries = redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+if retries > tonumber(ARGV[2]) then
+    redis.call('LPUSH', KEYS[3], ARGV[1])
+else
+    redis.call('ZADD', KEYS[4], ARGV[3], ARGV[1])
+end
+return retries
+"""
+
+
+def task_priority(task):
+    """Return the priority of a task in the work queue.
+
+    Larger tasks take longer, so they are given higher priorities and started
+    first, to keep them from holding up the end of a run.
+    """
+    return task.get('size_in_bytes', 0)
+
+
+class WorkQueue(object):
+    """The 'workqueue' sorted set of tasks waiting to be run, scored by their
+    priorities."""
+
+    def __init__(self, r):
+        self.r = r
+        self._take = r.register_script(TAKE_TASK_SCRIPT)
+        self._requeue = r.register_script(REQUEUE_SCRIPT)
+
+    def take(self, poll_interval=1.0):
+        """Move the task with the highest priority to the in progress list
+        and return its identifier, waiting for one if the queue is empty."""
+
+        # BZPOPMAX would wait without polling, but it cannot also push the
+        # task onto the in progress list, so a worker dying straight after
+        # it would lose the task. Polling an empty queue only costs one
+        # short script call per poll_interval for each idle worker.
+        while True:
+            task_identifier = self._take(keys=['workqueue', 'inprogress'])
+            if task_identifier is not None:
+                return task_identifier
+            time.sleep(poll_interval)
+
+    def requeue(self, task_identifier, max_retries):
+        """Return a failed or abandoned task to the work queue, or move it to
+        the dead letter list once it has been retried max_retries times."""
+
+        raw_task = self.r.hget('tasks', task_identifier)
+        priority = 0
+        if raw_task is not None:
+            priority = task_priority(json.loads(raw_task))
+
+        retries = self._requeue(
+            keys=['inprogress', 'retries', 'deadletter', 'workqueue'],
+            args=[task_identifier, max_retries, priority]
+        )
+
+        # Tasks no longer in progress have already been completed or
+        # requeued.
+        if retries is not None and retries > max_retries:
+            print("Giving up on {} after {} attempts".format(
+                task_identifier,
+                retries
+                )
+            )
+
+
+class Leases(object):
+    """Heartbeated leases on in progress tasks.
+
+    Each task taken from the work queue is given a lease in the 'leases'
+    sorted set, scored by the time at which it expires. A background thread
+    renews the leases of the tasks held by this worker and returns tasks
+    whose leases have expired, because the worker holding them died, to the
+    work queue.
+    """
+
+    def __init__(self, r, timeout, max_retries):
+        self.r = r
+        self.queue = WorkQueue(r)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.held = set()
+        self._lock = threading.Lock()
+
+    def acquire(self, task_identifier):
+        with self._lock:
+            self.held.add(task_identifier)
+        expiry = time.time() + self.timeout
+        self.r.zadd('leases', {task_identifier: expiry})
+
+    def _release(self, task_identifier):
+        with self._lock:
+            self.held.discard(task_identifier)
+
+    def complete(self, task_identifier):
+        self._release(task_identifier)
+
+        pipe = self.r.pipeline()
+        pipe.lrem('inprogress', 1, task_identifier)
+        pipe.zrem('leases', task_identifier)
+        pipe.lpush('completed', task_identifier)
+        pipe.hdel('retries', task_identifier)
+        pipe.execute()
+
+    def fail(self, task_identifier):
+        self._release(task_identifier)
+        self.queue.requeue(task_identifier, self.max_retries)
+        self.r.zrem('leases', task_identifier)
+
+    def heartbeat(self):
+        """Renew the leases of the tasks held by this worker."""
+        with self._lock:
+            held = list(self.held)
+
+        expiry = time.time() + self.timeout
+        for task_identifier in held:
+            # Only renew leases that have not already been reaped.
+            self.r.zadd('leases', {task_identifier: expiry}, xx=True)
+
+    def reap(self):
+        """Requeue the tasks whose leases have expired."""
+        now = time.time()
+
+        # Give a lease to in progress tasks without one, e.g. those taken by
+        # a worker that died before it could acquire the lease.
+        for task_identifier in self.r.lrange('inprogress', 0, -1):
+            self.r.zadd('leases', {task_identifier: now + self.timeout},
+                        nx=True)
+
+        for task_identifier in self.r.zrangebyscore('leases', 0, now):
+            with self._lock:
+                if task_identifier in self.held:
+                    continue
+            # Only the worker that removes the lease requeues the task.
+            if self.r.zrem('leases', task_identifier):
+                print("Lease expired on {}".format(task_identifier))
+                self.queue.requeue(task_identifier, self.max_retries)
+
+    def _run(self):
+        while True:
+            try:
+                self.heartbeat()
+                self.reap()
+            except Exception:
+                # Keep renewing this worker's leases whatever goes wrong, so
+                # that its tasks are not reaped and run twice.
+                traceback.print_exc()
+            time.sleep(self.timeout / 3.0)
+
+    def start(self):
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+
+class Metrics(object):
+    """Timings of tasks, published to Redis for progress.py.
+
+    - 'metrics:started' hash: start time of each task in progress
+    - 'metrics:finished' sorted set: tasks scored by when they finished
+    - 'metrics:finished:<worker>' sorted set: the same, for one worker
+    - 'metrics:durations' sorted set: tasks scored by how long they took
+    - 'metrics:counters' hash: numbers of tasks completed and failed
+    - 'metrics:workers' hash: when each worker last started or finished a
+      task
+    """
+
+    def __init__(self, r, worker_name):
+        self.r = r
+        self.worker_name = worker_name
+        self._started = {}
+
+    def started(self, task_identifier):
+        now = time.time()
+        self._started[task_identifier] = now
+
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hset('metrics:started', task_identifier, now)
+        pipe.hset('metrics:workers', self.worker_name, now)
+        pipe.execute()
+
+    def finished(self, task_identifier, succeeded):
+        now = time.time()
+        start = self._started.pop(task_identifier, now)
+
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hdel('metrics:started', task_identifier)
+        if succeeded:
+            pipe.zadd('metrics:finished', {task_identifier: now})
+            pipe.zadd('metrics:finished:' + self.worker_name,
+                      {task_identifier: now})
+            pipe.zadd('metrics:durations', {task_identifier: now - start})
+            pipe.hincrby('metrics:counters', 'completed', 1)
+        else:
+            pipe.hincrby('metrics:counters', 'failed', 1)
+        pipe.hset('metrics:workers', self.worker_name, now)
+        pipe.execute()
+
+
+def default_worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def process_tasks(r, leases, metrics, execute):
+    """Take tasks from the work queue and run them one at a time with execute,
+    which returns True if the task succeeded."""
+
+    queue = WorkQueue(r)
 
     while True:
-        task_identifier = r.brpoplpush('workqueue', 'inprogress')
+        task_identifier = queue.take()
+        leases.acquire(task_identifier)
+        metrics.started(task_identifier)
 
         raw_task = r.hget('tasks', task_identifier)
         task = json.loads(raw_task)
 
-        return_code = execute_task(task)
+        succeeded = execute(task)
+        metrics.finished(task_identifier, succeeded)
 
-        if return_code is 0:
-            r.lrem('inprogress', 1, task_identifier)
-            r.lpush('completed', task_identifier)
+        if succeeded:
+            leases.complete(task_identifier)
         else:
-            raise("BLEW UP HORRIBLY on {}".format(task["identifier"]))
+            print("Failed on {}".format(task["identifier"]))
+            leases.fail(task_identifier)
+
+
+def run_slot(redis_host, lease_timeout, max_retries, worker_name):
+    """Process tasks in the current process, one slot of a pool worker.
+
+    Each slot has its own connection and leases, so if its process dies the
+    lease on its task stops being renewed, and the task is returned to the
+    work queue once the lease expires.
+    """
+
+    r = redis.StrictRedis(host=redis_host, port=6379)
+
+    leases = Leases(r, lease_timeout, max_retries)
+    leases.start()
+
+    metrics = Metrics(r, worker_name)
+
+    process_tasks(r, leases, metrics, execute_task_in_process)
+
+
+def run_pool(slots, redis_host, lease_timeout, max_retries, worker_name):
+    """Process tasks in slots long-lived worker processes, each of which
+    takes, runs and completes its own tasks. Processes that die, for example
+    when they are killed for running out of memory, are replaced."""
+
+    args = (redis_host, lease_timeout, max_retries, worker_name)
+    processes = [None for _ in range(slots)]
+
+    try:
+        while True:
+            for slot, process in enumerate(processes):
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    print("Slot {} exited with status {}, restarting".format(
+                        slot,
+                        process.exitcode
+                        )
+                    )
+                process = multiprocessing.Process(target=run_slot, args=args)
+                process.start()
+                processes[slot] = process
+            time.sleep(1)
+    finally:
+        for process in processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+
+
+def run_serial(r, leases, metrics):
+    """Process tasks one at a time, running each tool in a new interpreter."""
+
+    process_tasks(r, leases, metrics, lambda task: execute_task(task) == 0)
+
+
+@click.command()
+@click.option('--redis-host', envvar='REDIS_HOST')
+@click.option('--pool', is_flag=True,
+              help='Run tasks in-process in a pool of warm worker processes')
+@click.option('--slots', type=int, envvar='WORKER_SLOTS',
+              default=multiprocessing.cpu_count(),
+              help='Number of concurrent tasks in pool mode '
+                   '(default: number of CPUs)')
+@click.option('--lease-timeout', type=float, default=600,
+              help='Seconds after which a task without a heartbeat is '
+                   'returned to the work queue')
+@click.option('--max-retries', type=int, default=3,
+              help='Attempts after the first before a task is moved to the '
+                   'dead letter list')
+@click.option('--name', envvar='WORKER_NAME', default=None,
+              help='Name of the worker in progress metrics '
+                   '(default: <hostname>:<pid>)')
+def main(redis_host, pool, slots, lease_timeout, max_retries, name):
+    worker_name = name or default_worker_name()
+
+    if pool:
+        run_pool(slots, redis_host, lease_timeout, max_retries, worker_name)
+        return
+
+    r = redis.StrictRedis(host=redis_host, port=6379)
+
+    leases = Leases(r, lease_timeout, max_retries)
+    leases.start()
+
+    metrics = Metrics(r, worker_name)
+
+    run_serial(r, leases, metrics)
 
 
 if __name__ == '__main__':